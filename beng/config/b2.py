@@ -11,7 +11,8 @@ config = C(
         self_distillation=C(
             start_epoch=100,
             target_weight=0.5,
-            pred_ewa=2 / 3),
+            pred_ewa=2 / 3,
+            topk=None),
         optimizer=C(
             type='sgd',
             lr=0.16,
@@ -1,5 +1,7 @@
+import functools
 import glob
 import os
+from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
@@ -9,8 +11,10 @@ from tqdm import tqdm
 
 from all_the_tools.torch.utils import one_hot
 from beng.transforms import invert
+from memmap import LazyMemmap
 
 IMAGE_SIZE = 137, 236
+FONT_SIZE = 120
 
 CLASS_META = pd.DataFrame({
     'component': ['grapheme_root', 'consonant_diacritic', 'vowel_diacritic'],
@@ -20,9 +24,10 @@ CLASS_META = pd.DataFrame({
 
 
 class LabeledDataset(torch.utils.data.Dataset):
-    def __init__(self, data, transform=None):
+    def __init__(self, data, transform=None, images=None):
         self.data = data
         self.transform = transform
+        self.images = images
 
     def __len__(self):
         return len(self.data)
@@ -30,7 +35,10 @@ class LabeledDataset(torch.utils.data.Dataset):
     def __getitem__(self, i):
         item = self.data.iloc[i]
 
-        image = Image.open(item['image_path'])
+        if self.images is not None:
+            image = Image.fromarray(np.array(self.images[item['image_index']]))
+        else:
+            image = Image.open(item['image_path'])
 
         if self.transform is not None:
             image = self.transform(image)
@@ -44,21 +52,60 @@ class LabeledDataset(torch.utils.data.Dataset):
         return image, target, i
 
 
+class ImageStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.images = LazyMemmap(os.path.join(path, 'images.npy'))
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, i):
+        return self.images[i]
+
+
+class FakeImageStore(ImageStore):
+    def __init__(self, path):
+        super().__init__(path)
+
+        graphemes = np.load(os.path.join(path, 'graphemes.npy'))
+        self.grapheme_index = {grapheme: i for i, grapheme in enumerate(graphemes)}
+        self.font_paths = np.load(os.path.join(path, 'font_paths.npy')).tolist()
+
+    def __getitem__(self, key):
+        grapheme, font = key
+
+        return super().__getitem__((self.grapheme_index[grapheme], font))
+
+
 class FakeDataset(torch.utils.data.Dataset):
-    def __init__(self, data, size, transform=None):
+    def __init__(self, data, size, transform=None, font_paths=None, cache_size=4096, images=None):
+        if font_paths is None:
+            font_paths = list_font_paths()
+        if images is not None:
+            assert images.font_paths == list(font_paths)
+
         self.data = data
         self.size = size
         self.transform = transform
+        self.font_paths = font_paths
+        self.cache_size = cache_size
+        self.images = images
+        self.render = None
 
     def __len__(self):
         return self.size
 
     def __getitem__(self, i):
-        i = np.random.choice(len(self))
+        i = np.random.choice(len(self.data))
         item = self.data.iloc[i]
 
-        font = ImageFont.truetype(np.random.choice(glob.glob('./beng/fonts/*.ttf')), 120)
-        image = char_to_image(item['grapheme'], font)
+        font = np.random.choice(len(self.font_paths))
+        if self.images is not None:
+            image = self.images[item['grapheme'], font]
+        else:
+            image = self.render_cached(item['grapheme'], font)
+        image = Image.fromarray(np.array(image))
 
         if self.transform is not None:
             image = self.transform(image)
@@ -71,10 +118,28 @@ class FakeDataset(torch.utils.data.Dataset):
 
         return image, target
 
+    def render_cached(self, grapheme, font):
+        if self.render is None:
+            self.render = build_renderer(self.font_paths, cache_size=self.cache_size)
+
+        return self.render(grapheme, font)
 
-def load_labeled_data(metadata_path, parquet_paths, cache_path):
+
+def load_labeled_data(metadata_path, parquet_paths, cache_path, store='png'):
     data = pd.read_csv(metadata_path)
     data = data.set_index('image_id')
+
+    if store == 'png':
+        load_png_images(data, parquet_paths, cache_path)
+    elif store == 'memmap':
+        load_memmap_images(data, parquet_paths, cache_path)
+    else:
+        raise AssertionError('invalid store {}'.format(store))
+
+    return data
+
+
+def load_png_images(data, parquet_paths, cache_path):
     data['image_path'] = data.index.map(lambda id: os.path.join(cache_path, '{}.png'.format(id)))
 
     if not os.path.exists(cache_path):
@@ -89,7 +154,94 @@ def load_labeled_data(metadata_path, parquet_paths, cache_path):
                     zip(parquet.index, images), total=len(parquet), desc='loading {}'.format(parquet_path)):
                 Image.fromarray(image).save(os.path.join(cache_path, '{}.png'.format(id)))
 
-    return data
+
+def load_memmap_images(data, parquet_paths, cache_path):
+    # build_image_store saves image_ids.npy after the images
+    if not os.path.exists(os.path.join(cache_path, 'image_ids.npy')):
+        build_image_store(parquet_paths, cache_path)
+
+    image_ids = np.load(os.path.join(cache_path, 'image_ids.npy'))
+    image_index = pd.Series(np.arange(len(image_ids)), index=image_ids)
+    data['image_index'] = image_index[data.index].values
+
+
+def build_image_store(parquet_paths, cache_path):
+    import pyarrow.parquet as pq
+
+    os.makedirs(cache_path, exist_ok=True)
+
+    size = sum(pq.ParquetFile(parquet_path).metadata.num_rows for parquet_path in parquet_paths)
+    images = np.lib.format.open_memmap(
+        os.path.join(cache_path, 'images.npy'), mode='w+', dtype=np.uint8, shape=(size, *IMAGE_SIZE))
+
+    image_ids = []
+    for parquet_path in tqdm(parquet_paths, desc='loading parquet files'):
+        parquet = pd.read_parquet(parquet_path)
+        parquet = parquet.set_index('image_id')
+
+        offset = len(image_ids)
+        images[offset:offset + len(parquet)] = parquet.values.reshape(len(parquet), *IMAGE_SIZE)
+        image_ids.extend(parquet.index)
+
+        del parquet
+    assert len(image_ids) == size
+
+    images.flush()
+    np.save(os.path.join(cache_path, 'image_ids.npy'), np.array(image_ids))
+
+
+def load_fake_images(graphemes, cache_path, font_paths=None, workers=None):
+    if font_paths is None:
+        font_paths = list_font_paths()
+
+    if not os.path.exists(os.path.join(cache_path, 'graphemes.npy')):
+        build_fake_image_store(graphemes, font_paths, cache_path, workers=workers)
+
+    images = FakeImageStore(cache_path)
+    assert images.font_paths == sorted(font_paths)
+
+    return images
+
+
+def build_fake_image_store(graphemes, font_paths, cache_path, workers=None):
+    graphemes = sorted(set(graphemes))
+    font_paths = sorted(font_paths)
+
+    os.makedirs(cache_path, exist_ok=True)
+    images = np.lib.format.open_memmap(
+        os.path.join(cache_path, 'images.npy'), mode='w+', dtype=np.uint8,
+        shape=(len(graphemes), len(font_paths), *IMAGE_SIZE))
+
+    with Pool(workers) as pool:
+        tasks = [(font_path, graphemes) for font_path in font_paths]
+        for font, font_images in enumerate(
+                tqdm(pool.imap(render_font, tasks), total=len(tasks), desc='rendering fonts')):
+            images[:, font] = font_images
+
+    images.flush()
+    np.save(os.path.join(cache_path, 'font_paths.npy'), np.array(font_paths))
+    np.save(os.path.join(cache_path, 'graphemes.npy'), np.array(graphemes))
+
+
+def render_font(task):
+    font_path, graphemes = task
+    font = ImageFont.truetype(font_path, FONT_SIZE)
+
+    return np.stack([np.array(char_to_image(grapheme, font)) for grapheme in graphemes], 0)
+
+
+def build_renderer(font_paths, cache_size=None):
+    fonts = [ImageFont.truetype(font_path, FONT_SIZE) for font_path in font_paths]
+
+    @functools.lru_cache(maxsize=cache_size)
+    def render(grapheme, font):
+        return np.array(char_to_image(grapheme, fonts[font]))
+
+    return render
+
+
+def list_font_paths():
+    return sorted(glob.glob('./beng/fonts/*.ttf'))
 
 
 def split_target(target, dim=-1):
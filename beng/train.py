@@ -1,3 +1,4 @@
+import functools
 import glob
 import importlib.util
 import math
@@ -6,7 +7,6 @@ import os
 import click
 import matplotlib.pyplot as plt
 import numpy as np
-import sklearn
 import torch
 import torch.utils.data
 import torchvision
@@ -18,13 +18,13 @@ from tqdm import tqdm
 
 import utils
 from all_the_tools.metrics import Last, Mean, Metric, Concat
-from all_the_tools.torch.losses import softmax_cross_entropy
 from all_the_tools.torch.optim import LookAhead
 from all_the_tools.torch.utils import Saver
 from all_the_tools.utils import seed_python
-from beng.dataset import LabeledDataset, load_labeled_data, split_target, CLASS_META, decode_target, IMAGE_SIZE
+from beng.dataset import LabeledDataset, ImageStore, load_labeled_data, split_target, encode_target, CLASS_META, \
+    decode_target, IMAGE_SIZE
 from beng.model import Model
-from beng.transforms import Invert
+from beng.transforms import Invert, ToByteTensor, BatchInvert, BatchRandomAffineCrop, BatchCenterCrop, BatchNormalize
 from lr_scheduler import OneCycleScheduler, CosineWithWarmup
 from transforms import Resettable
 
@@ -91,25 +91,38 @@ DEVICE = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
 class HMAR(Metric):
     def compute(self):
-        input = np.concatenate(self.input, 0)
-        target = np.concatenate(self.target, 0)
-
-        scores = [
-            sklearn.metrics.recall_score(target[..., i], input[..., i], average='macro')
-            for i in range(input.shape[-1])
-        ]
+        scores = []
+        for confusion, recall in zip(self.confusions, self.compute_per_class()):
+            # same label set as sklearn: classes present either in targets or in predictions
+            present = (confusion.sum(0) + confusion.sum(1)) > 0
+            scores.append(recall[present].mean().item())
 
         hmar = np.average(scores, weights=CLASS_META['weight'].values)
 
         return hmar
 
+    def compute_per_class(self):
+        recalls = []
+        for confusion in self.confusions:
+            tp = confusion.diag().float()
+            support = confusion.sum(1).float()
+            recalls.append(tp / support.clamp(min=1))
+
+        return recalls
+
     def update(self, input, target):
-        self.input.append(input)
-        self.target.append(target)
+        if self.confusions is None:
+            self.confusions = [
+                torch.zeros(num_classes, num_classes, dtype=torch.long, device=input.device)
+                for num_classes in CLASS_META['num_classes']]
+
+        for i, num_classes in enumerate(CLASS_META['num_classes']):
+            num_classes = int(num_classes)
+            confusion = torch.bincount(target[..., i] * num_classes + input[..., i], minlength=num_classes**2)
+            self.confusions[i] += confusion.view(num_classes, num_classes)
 
     def reset(self):
-        self.input = []
-        self.target = []
+        self.confusions = None
 
 
 def compute_weight_from_loss(loss):
@@ -134,59 +147,57 @@ def worker_init_fn(_):
     seed_python(torch.initial_seed() % 2**32)
 
 
-def softmax_recall_loss(input, target, dim=-1, eps=1e-7):
-    assert input.dim() == 2
-    assert input.size() == target.size()
-
-    input = input.softmax(dim)
+@functools.lru_cache()
+def component_layout(device):
+    num_classes = CLASS_META['num_classes'].values
+    offsets = np.cumsum(num_classes) - num_classes
 
-    tp = (target * input).sum()
-    fn = (target * (1 - input)).sum()
-    r = tp / (tp + fn + eps)
+    # position of every component class in the flat layout, padding points one past the end
+    index = np.full((len(num_classes), num_classes.max()), num_classes.sum())
+    for i, (offset, n) in enumerate(zip(offsets, num_classes)):
+        index[i, :n] = np.arange(offset, offset + n)
 
-    loss = 1 - r
+    index = torch.tensor(index, dtype=torch.long, device=device)
+    mask = index < num_classes.sum()
+    num_classes = torch.tensor(num_classes, dtype=torch.float, device=device)
+    weight = torch.tensor(CLASS_META['weight'].values, dtype=torch.float, device=device)
 
-    return loss
+    return index, mask, num_classes, weight
 
 
-def softmax_entropy(input, dim=-1):
-    prob = input.softmax(dim)
-    log_prob = input.log_softmax(dim)
+def pad_components(input, value):
+    index, _, _, _ = component_layout(input.device)
+    input = torch.cat([input, input.new_full((input.size(0), 1), value)], 1)
 
-    return -(prob * log_prob).sum(dim)
+    return input[:, index]
 
 
-def compute_entropy(input):
-    def compute(input, dim=-1):
-        return softmax_entropy(input, dim=dim)
+def compute_loss(input, target, config, eps=1e-7):
+    _, mask, num_classes, weight = component_layout(input.device)
 
-    input = split_target(input)
-    entropy = [compute(i) for i in input]
-    entropy = torch.stack(entropy, -1)
+    # (B, 186) -> (B, 3, 168), padded logits vanish under softmax and padded targets are zero
+    input = pad_components(input, -1e4)
+    target = pad_components(target, 0.)
 
-    return entropy
+    if config.label_smoothing is not None:
+        target = target * (1 - config.label_smoothing) + config.label_smoothing / num_classes.view(1, -1, 1)
+        target = target * mask.float()
 
+    log_prob = input.log_softmax(-1)
+    prob = log_prob.exp()
 
-def compute_loss(input, target, config):
-    def compute(input, target, dim=-1):
-        if config.label_smoothing is not None:
-            target = utils.label_smoothing(target, eps=config.label_smoothing)
+    ce = -(target * log_prob).sum(-1)
+    r = 1 - (target * prob).sum((0, 2)) / (target.sum((0, 2)) + eps)
+    entropy = -(prob * log_prob).sum(-1)
 
-        ce = softmax_cross_entropy(input=input, target=target, axis=dim)
-        r = softmax_recall_loss(input=input, target=target, dim=dim)
+    loss = weighted_sum(ce.mean(0), r, 0.5)
+    loss = (loss * weight).sum()
 
-        loss = weighted_sum(ce.mean(), r.mean(), 0.5)
-
-        return loss
-
-    input = split_target(input)
-    target = split_target(target)
-
-    loss = [compute(input=i, target=t) for i, t in zip(input, target)]
-    assert len(loss) == len(CLASS_META['weight'].values)
-    loss = sum([l * w for l, w in zip(loss, CLASS_META['weight'].values)])
-
-    return loss
+    return loss, {
+        'ce': ce,
+        'recall': r,
+        'entropy': entropy,
+    }
 
 
 def indices_for_fold(data, fold, seed):
@@ -275,7 +286,7 @@ def load_config(config_path, **kwargs):
     return config
 
 
-def build_transforms():
+def build_transforms(batch_aug):
     def update_transforms(p):
         crop_size = tuple([
             round(size // 2 + (size - size // 2) * p)
@@ -286,32 +297,55 @@ def build_transforms():
 
         print('update transforms p: {:.2f}, crop_size: {}'.format(p, crop_size))
 
-    random_crop = Resettable(T.RandomCrop)
-    center_crop = Resettable(T.CenterCrop)
-
-    to_tensor_and_norm = T.Compose([
-        T.ToTensor(),
-        T.Normalize(
-            np.mean((0.485, 0.456, 0.406), keepdims=True),
-            np.mean((0.229, 0.224, 0.225), keepdims=True)),
-    ])
-    train_transform = T.Compose([
-        Invert(),
-        T.RandomAffine(degrees=15, scale=(0.8, 1 / 0.8), resample=Image.BILINEAR),
-        random_crop,
-        to_tensor_and_norm,
-        # T.RandomErasing(value=0),
-    ])
-    eval_transform = T.Compose([
-        Invert(),
-        center_crop,
-        to_tensor_and_norm,
-    ])
-
-    return train_transform, eval_transform, update_transforms
-
-
-def train_epoch(model, data_loader, fold_probs, optimizer, scheduler, epoch, config):
+    mean = np.mean((0.485, 0.456, 0.406), keepdims=True)
+    std = np.mean((0.229, 0.224, 0.225), keepdims=True)
+
+    if batch_aug:
+        # workers only collate uint8 images, augmentation runs on the whole batch on device
+        random_crop = Resettable(
+            lambda size: BatchRandomAffineCrop(size, degrees=15, scale=(0.8, 1 / 0.8)))
+        center_crop = Resettable(BatchCenterCrop)
+
+        normalize = BatchNormalize(mean.item(), std.item())
+        train_transform = ToByteTensor()
+        eval_transform = ToByteTensor()
+        train_batch_transform = T.Compose([
+            BatchInvert(),
+            random_crop,
+            normalize,
+        ])
+        eval_batch_transform = T.Compose([
+            BatchInvert(),
+            center_crop,
+            normalize,
+        ])
+    else:
+        random_crop = Resettable(T.RandomCrop)
+        center_crop = Resettable(T.CenterCrop)
+
+        to_tensor_and_norm = T.Compose([
+            T.ToTensor(),
+            T.Normalize(mean, std),
+        ])
+        train_transform = T.Compose([
+            Invert(),
+            T.RandomAffine(degrees=15, scale=(0.8, 1 / 0.8), resample=Image.BILINEAR),
+            random_crop,
+            to_tensor_and_norm,
+            # T.RandomErasing(value=0),
+        ])
+        eval_transform = T.Compose([
+            Invert(),
+            center_crop,
+            to_tensor_and_norm,
+        ])
+        train_batch_transform = T.Compose([])
+        eval_batch_transform = T.Compose([])
+
+    return train_transform, eval_transform, train_batch_transform, eval_batch_transform, update_transforms
+
+
+def train_epoch(model, data_loader, batch_transform, fold_probs, optimizer, scheduler, epoch, config):
     writer = SummaryWriter(os.path.join(config.experiment_path, 'F{}'.format(config.fold), 'train'))
     metrics = {
         'loss': Mean(),
@@ -323,6 +357,7 @@ def train_epoch(model, data_loader, fold_probs, optimizer, scheduler, epoch, con
     model.train()
     for images, targets, indices in tqdm(data_loader, desc='[F{}][epoch {}] train'.format(config.fold, epoch)):
         images, targets, indices = images.to(DEVICE), targets.to(DEVICE), indices.to(DEVICE)
+        images = batch_transform(images)
 
         if epoch >= config.train.self_distillation.start_epoch:
             targets = weighted_sum(targets, fold_probs[indices], config.train.self_distillation.target_weight)
@@ -332,11 +367,11 @@ def train_epoch(model, data_loader, fold_probs, optimizer, scheduler, epoch, con
 
         logits, etc = model(images)
 
-        loss = compute_loss(input=logits, target=targets, config=config.train)
+        loss, terms = compute_loss(input=logits, target=targets, config=config.train)
 
         metrics['loss'].update(loss.data.cpu().numpy())
         metrics['loss_hist'].update(loss.data.cpu().numpy())
-        metrics['entropy'].update(compute_entropy(logits).data.cpu().numpy())
+        metrics['entropy'].update(terms['entropy'].data.cpu().numpy())
         metrics['lr'].update(np.squeeze(scheduler.get_lr()))
 
         loss.mean().backward()
@@ -364,7 +399,7 @@ def train_epoch(model, data_loader, fold_probs, optimizer, scheduler, epoch, con
     writer.close()
 
 
-def eval_epoch(model, data_loader, epoch, config):
+def eval_epoch(model, data_loader, batch_transform, epoch, config):
     writer = SummaryWriter(os.path.join(config.experiment_path, 'F{}'.format(config.fold), 'eval'))
     metrics = {
         'loss': Mean(),
@@ -377,18 +412,21 @@ def eval_epoch(model, data_loader, epoch, config):
         model.eval()
         for images, targets, _ in tqdm(data_loader, desc='[F{}][epoch {}] eval'.format(config.fold, epoch)):
             images, targets = images.to(DEVICE), targets.to(DEVICE)
+            images = batch_transform(images)
 
             logits, etc = model(images)
 
-            loss = compute_loss(input=logits, target=targets, config=config.train)
+            loss, terms = compute_loss(input=logits, target=targets, config=config.train)
 
             metrics['loss'].update(loss.data.cpu().numpy())
             metrics['loss_hist'].update(loss.data.cpu().numpy())
-            metrics['entropy'].update(compute_entropy(logits).data.cpu().numpy())
+            metrics['entropy'].update(terms['entropy'].data.cpu().numpy())
             metrics['hmar'].update(
-                input=decode_target(logits).data.cpu().numpy(),
-                target=decode_target(targets).data.cpu().numpy())
+                input=decode_target(logits),
+                target=decode_target(targets))
 
+    for component, recall in zip(CLASS_META['component'], metrics['hmar'].compute_per_class()):
+        writer.add_histogram('recall/{}'.format(component), recall.data.cpu().numpy(), global_step=epoch)
     for k in metrics:
         if k.endswith('_hist'):
             writer.add_histogram(k, metrics[k].compute_and_reset(), global_step=epoch)
@@ -404,8 +442,8 @@ def eval_epoch(model, data_loader, epoch, config):
     writer.close()
 
 
-def lr_search(train_data, train_transform, config):
-    train_dataset = LabeledDataset(train_data, transform=train_transform)
+def lr_search(train_data, train_transform, train_batch_transform, image_store, config):
+    train_dataset = LabeledDataset(train_data, transform=train_transform, images=image_store)
     train_data_loader = torch.utils.data.DataLoader(
         train_dataset,
         batch_size=config.train.batch_size,
@@ -432,13 +470,14 @@ def lr_search(train_data, train_transform, config):
     model.train()
     for images, targets, _ in tqdm(train_data_loader, desc='lr_search'):
         images, targets = images.to(DEVICE), targets.to(DEVICE)
+        images = train_batch_transform(images)
 
         if config.train.cutmix is not None:
             images, targets = utils.cutmix(images, targets, config.train.cutmix)
 
         logits, etc = model(images)
 
-        loss = compute_loss(input=logits, target=targets, config=config.train)
+        loss, _ = compute_loss(input=logits, target=targets, config=config.train)
 
         lrs.append(np.squeeze(scheduler.get_lr()))
         losses.append(loss.data.cpu().numpy().mean())
@@ -481,19 +520,69 @@ def lr_search(train_data, train_transform, config):
     return minima_lr
 
 
-def build_dataset_targets(dataset, config):
-    data_loader = torch.utils.data.DataLoader(
-        dataset,
-        batch_size=config.train.batch_size,
-        num_workers=config.workers,
-        worker_init_fn=worker_init_fn)
-    probs = torch.zeros(len(dataset), CLASS_META['num_classes'].sum(), dtype=torch.float, device=DEVICE)
+class TargetStore(object):
+    def __init__(self, data, topk=None, device=DEVICE):
+        self.topk = topk
+
+        targets = torch.tensor(data[CLASS_META['component']].values, dtype=torch.long)
+        targets = encode_target(targets).to(device)
+
+        if self.topk is None:
+            self.probs = targets.half()
+        else:
+            self.values = []
+            self.indices = []
+            for target in split_target(targets):
+                values, indices = self.sparsify(target)
+                self.values.append(values)
+                self.indices.append(indices)
+
+    def __len__(self):
+        if self.topk is None:
+            return self.probs.size(0)
+        else:
+            return self.values[0].size(0)
+
+    def __getitem__(self, indices):
+        if self.topk is None:
+            return self.probs[indices].float()
+
+        probs = []
+        for values, i, num_classes in zip(self.values, self.indices, CLASS_META['num_classes']):
+            prob = torch.zeros(indices.size(0), int(num_classes), device=values.device)
+            prob.scatter_(1, i[indices].long(), values[indices].float())
+            probs.append(prob)
+        probs = torch.cat(probs, 1)
+
+        return probs
 
-    for _, targets, indices in tqdm(data_loader, desc='build targets'):
-        assert probs.dtype == targets.dtype
-        probs[indices] = targets.to(DEVICE)
+    def __setitem__(self, indices, probs):
+        if self.topk is None:
+            self.probs[indices] = probs.half()
+            return
 
-    return probs
+        for values, i, target in zip(self.values, self.indices, split_target(probs)):
+            values[indices], i[indices] = self.sparsify(target)
+
+    def sparsify(self, target):
+        # top-k is renormalized so that every component stays a distribution
+        values, indices = target.topk(min(self.topk, target.size(1)), 1)
+        values = values / values.sum(1, keepdim=True)
+
+        return values.half(), indices.short()
+
+    def state_dict(self):
+        if self.topk is None:
+            return {'probs': self.probs}
+        else:
+            return {'values': self.values, 'indices': self.indices}
+
+    def load_state_dict(self, state_dict):
+        if self.topk is None:
+            self.probs = state_dict['probs']
+        else:
+            self.values = state_dict['values']
+            self.indices = state_dict['indices']
 
 
 @click.command()
@@ -503,32 +592,43 @@ def build_dataset_targets(dataset, config):
 @click.option('--restore-path', type=click.Path())
 @click.option('--fold', type=click.INT, required=True)
 @click.option('--lr-search', is_flag=True)
+@click.option('--image-store', type=click.Choice(['png', 'memmap']), default='memmap')
+@click.option('--batch-aug', is_flag=True)
 @click.option('--workers', type=click.INT, default=os.cpu_count())
 def main(**kwargs):
     # TODO: seed everything
     config = load_config(**kwargs)  # FIXME:
     del kwargs
 
+    if config.image_store == 'memmap':
+        cache_path = os.path.join(config.dataset_path, 'train_images_memmap')
+        images = ImageStore(cache_path)
+    else:
+        cache_path = os.path.join(config.dataset_path, 'train_images')
+        images = None
+
     train_eval_data = load_labeled_data(
         os.path.join(config.dataset_path, 'train.csv'),
         glob.glob(os.path.join(config.dataset_path, 'train_image_data_*.parquet')),
-        cache_path=os.path.join(config.dataset_path, 'train_images'))
+        cache_path=cache_path,
+        store=config.image_store)
 
     train_indices, eval_indices = indices_for_fold(train_eval_data, fold=config.fold, seed=config.seed)
 
-    train_transform, eval_transform, update_transforms = build_transforms()
+    train_transform, eval_transform, train_batch_transform, eval_batch_transform, update_transforms = \
+        build_transforms(config.batch_aug)
 
     if config.lr_search:
         update_transforms(1.)
-        lr_search(train_eval_data, train_transform, config)
+        lr_search(train_eval_data, train_transform, train_batch_transform, images, config)
         return
 
-    train_dataset = LabeledDataset(train_eval_data.iloc[train_indices], transform=train_transform)
+    train_dataset = LabeledDataset(train_eval_data.iloc[train_indices], transform=train_transform, images=images)
     train_dataset = torch.utils.data.ConcatDataset([
         train_dataset,
         # FakeDataset(train_eval_data, len(train_dataset) // 4, transform=train_transform)
     ])
-    eval_dataset = LabeledDataset(train_eval_data.iloc[eval_indices], transform=eval_transform)
+    eval_dataset = LabeledDataset(train_eval_data.iloc[eval_indices], transform=eval_transform, images=images)
 
     train_data_loader = torch.utils.data.DataLoader(
         train_dataset,
@@ -548,21 +648,22 @@ def main(**kwargs):
         model.parameters(), config.train.optimizer)
     scheduler = build_scheduler(
         optimizer, config.train.scheduler, config.train.optimizer, config.epochs, len(train_data_loader))
+    fold_probs = TargetStore(train_eval_data.iloc[train_indices], topk=config.train.self_distillation.topk)
     saver = Saver({
         'model': model,
         'optimizer': optimizer,
         'scheduler': scheduler,
+        'fold_probs': fold_probs,
     })
     if config.restore_path is not None:
         saver.load(config.restore_path, keys=['model'])
 
-    update_transforms(0)
-    fold_probs = build_dataset_targets(train_dataset, config)
-
     for epoch in range(1, config.epochs + 1):
         update_transforms((epoch - 1) / (config.epochs - 1))
-        train_epoch(model, train_data_loader, fold_probs, optimizer, scheduler, epoch=epoch, config=config)
-        eval_epoch(model, eval_data_loader, epoch=epoch, config=config)
+        train_epoch(
+            model, train_data_loader, train_batch_transform, fold_probs, optimizer, scheduler,
+            epoch=epoch, config=config)
+        eval_epoch(model, eval_data_loader, eval_batch_transform, epoch=epoch, config=config)
         saver.save(
             os.path.join(
                 config.experiment_path,
@@ -1,3 +1,8 @@
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
 from PIL import ImageOps
 
 
@@ -6,5 +11,74 @@ class Invert(object):
         return invert(input)
 
 
+class ToByteTensor(object):
+    def __call__(self, input):
+        return torch.from_numpy(np.array(input)).unsqueeze(0)
+
+
+class BatchInvert(object):
+    def __call__(self, input):
+        return 1 - input.float() / 255
+
+
+class BatchRandomAffineCrop(object):
+    def __init__(self, size, degrees, scale):
+        self.size = size
+        self.degrees = degrees
+        self.scale = scale
+
+    def __call__(self, input):
+        b, c, h, w = input.size()
+        th, tw = self.size
+
+        angle = torch.empty(b, device=input.device).uniform_(-self.degrees, self.degrees) * math.pi / 180
+        scale = torch.empty(b, device=input.device).uniform_(*self.scale)
+        i = torch.randint(0, h - th + 1, (b,), device=input.device).float()
+        j = torch.randint(0, w - tw + 1, (b,), device=input.device).float()
+
+        # inverse rotation and scaling about the image center, in normalized coordinates
+        cos, sin = angle.cos() / scale, angle.sin() / scale
+        affine = torch.stack([
+            torch.stack([cos, sin * h / w], 1),
+            torch.stack([-sin * w / h, cos], 1),
+        ], 1)
+
+        # maps normalized crop coordinates to normalized coordinates of the full image
+        crop_scale = torch.tensor([tw / w, th / h], device=input.device)
+        crop_shift = torch.stack([(tw + 2 * j) / w - 1, (th + 2 * i) / h - 1], 1)
+
+        theta = torch.cat([
+            affine * crop_scale.view(1, 1, 2),
+            torch.bmm(affine, crop_shift.unsqueeze(2)),
+        ], 2)
+
+        grid = F.affine_grid(theta, (b, c, th, tw), align_corners=False)
+        input = F.grid_sample(input, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+        return input
+
+
+class BatchCenterCrop(object):
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, input):
+        _, _, h, w = input.size()
+        th, tw = self.size
+        i = int(round((h - th) / 2.))
+        j = int(round((w - tw) / 2.))
+
+        return input[:, :, i:i + th, j:j + tw]
+
+
+class BatchNormalize(object):
+    def __init__(self, mean, std):
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, input):
+        return (input - self.mean) / self.std
+
+
 def invert(input):
     return ImageOps.invert(input)
@@ -1,7 +1,7 @@
 import torch
 import torch.nn.functional as F
 
-from lovasz_losses import lovasz_softmax as _lovasz_softmax
+from lovasz_losses import lovasz_hinge_batched, lovasz_softmax_batched
 
 
 # TODO: add reduction argument
@@ -109,6 +109,57 @@ def iou_loss(input, target, axis=None, eps=1e-7):
     return loss
 
 
+def label_sum(input, target):
+    # sums input (B, C, ...) over pixels labeled with each class in target (B, ...), giving (B, C)
+    # without building a one-hot target
+    input = input.flatten(2)
+    target = target.flatten(1)
+
+    value = input.gather(1, target.unsqueeze(1)).squeeze(1)
+    sum = torch.zeros(input.size()[:2], dtype=input.dtype, device=input.device).scatter_add_(1, target, value)
+
+    return sum
+
+
+def label_count(target, num_classes, dtype=torch.float):
+    target = target.flatten(1)
+
+    ones = torch.ones(target.size(), dtype=dtype, device=target.device)
+    count = torch.zeros(target.size(0), num_classes, dtype=dtype, device=target.device).scatter_add_(1, target, ones)
+
+    return count
+
+
+def label_dice_loss(input, target, smooth=1.):
+    # same as dice_loss over spatial axes with one-hot target, target is an integer label map
+    intersection = label_sum(input, target)
+    union = input.flatten(2).sum(2) + label_count(target, input.size(1), dtype=input.dtype)
+    dice = (2. * intersection + smooth) / (union + smooth)
+
+    loss = 1 - dice
+
+    return loss
+
+
+def label_iou_loss(input, target, eps=1e-7):
+    # same as iou_loss over spatial axes with one-hot target, target is an integer label map
+    intersection = label_sum(input, target)
+    union = input.flatten(2).sum(2) + label_count(target, input.size(1), dtype=input.dtype) - intersection
+    iou = intersection / (union + eps)
+
+    loss = 1 - iou
+
+    return loss
+
+
+def label_sigmoid_cross_entropy(input, target):
+    # sigmoid_cross_entropy with one-hot target averaged over spatial axes, target is an integer label map
+    loss = F.softplus(input).flatten(2).sum(2) - label_sum(input, target)
+    loss = loss / input.flatten(2).size(2)
+
+    return loss
+
+
 def sigmoid_cross_entropy(input, target):
     loss = F.binary_cross_entropy_with_logits(input=input, target=target, reduction='none')
 
@@ -160,10 +211,20 @@ def fbeta_score(input, target, beta=1., eps=1e-7):
     return fbeta
 
 
-def softmax_lovasz_loss(input, target):
+def softmax_lovasz_loss(input, target, per_image=False):
+    # target is either one-hot (B, C, H, W) or a label map (B, H, W)
     input = input.softmax(1)
-    target = target.argmax(1)
-    loss = _lovasz_softmax(probas=input, labels=target)
+    if target.dim() == input.dim():
+        target = target.argmax(1)
+    loss = lovasz_softmax_batched(probas=input, labels=target, per_image=per_image)
+
+    return loss
+
+
+def lovasz_loss(input, target):
+    # multi-label lovasz hinge, computed per sample over classes
+    target = (target > 0.5).float()
+    loss = lovasz_hinge_batched(logits=input, labels=target).mean()
 
     return loss
 
@@ -31,6 +31,22 @@ def lovasz_grad(gt_sorted):
     return jaccard
 
 
+def lovasz_grad_batched(gt_sorted, valid_sorted=None):
+    """
+    Computes gradients of the Lovasz extension w.r.t sorted errors along the last dimension
+    valid_sorted marks non void predictions, void ones are expected to be sorted last
+    """
+    gt_sorted = gt_sorted.float()
+    if valid_sorted is None:
+        valid_sorted = torch.ones_like(gt_sorted)
+    gts = gt_sorted.sum(-1, keepdim=True)
+    intersection = gts - gt_sorted.cumsum(-1)
+    union = gts + (valid_sorted - gt_sorted).cumsum(-1)
+    jaccard = 1. - intersection / union.clamp(min=1.)
+    jaccard[..., 1:] = jaccard[..., 1:] - jaccard[..., :-1].clone()
+    return jaccard * valid_sorted
+
+
 def iou_binary(preds, labels, EMPTY=1., ignore=None, per_image=True):
     """
     IoU for foreground class
@@ -92,6 +108,21 @@ def lovasz_hinge(logits, labels, per_image=True, ignore=None):
     return loss
 
 
+def lovasz_hinge_batched(logits, labels):
+    """
+    Binary Lovasz hinge loss for every row, errors of all rows are sorted with a single sort
+      logits: [N, P] Variable, logits at each prediction (between -\infty and +\infty)
+      labels: [N, P] Tensor, binary ground truth labels (0 or 1)
+    """
+    signs = 2. * labels.float() - 1.
+    errors = (1. - logits * signs)
+    errors_sorted, perm = torch.sort(errors, dim=-1, descending=True)
+    gt_sorted = labels.gather(-1, perm)
+    grad = lovasz_grad_batched(gt_sorted)
+    loss = (F.relu(errors_sorted) * grad).sum(-1)
+    return loss
+
+
 def lovasz_hinge_flat(logits, labels):
     """
     Binary Lovasz hinge loss
@@ -170,6 +201,48 @@ def lovasz_softmax(probas, labels, classes='present', per_image=False, ignore=No
     return loss
 
 
+def lovasz_softmax_batched(probas, labels, classes='present', per_image=False, ignore=None):
+    """
+    Multi-class Lovasz-Softmax loss, same as lovasz_softmax but errors of all (image, class) pairs
+    are sorted with a single sort and gradients are computed with batched cumsums
+      probas: [B, C, H, W] Variable, class probabilities at each prediction (between 0 and 1).
+              Interpreted as binary (sigmoid) output with outputs of size [B, H, W].
+      labels: [B, H, W] Tensor, ground truth labels (between 0 and C - 1)
+      classes: 'all' for all, 'present' for classes present in labels, or a list of classes to average.
+      per_image: compute the loss per image instead of per batch
+      ignore: void class labels
+    """
+    if probas.dim() == 3:
+        # assumes output of a sigmoid layer
+        probas = probas.unsqueeze(1)
+    B, C = probas.size()[:2]
+    probas = probas.view(B, C, -1)
+    labels = labels.view(B, -1)
+    if not per_image:
+        probas = probas.permute(1, 0, 2).contiguous().view(1, C, -1)
+        labels = labels.view(1, -1)
+
+    valid = torch.ones_like(labels, dtype=torch.bool) if ignore is None else labels != ignore
+    fg = ((labels.unsqueeze(1) == torch.arange(C, device=labels.device).view(1, C, 1)) & valid.unsqueeze(1)).float()
+    # void predictions get a negative error, so they are sorted after all valid ones
+    errors = torch.where(valid.unsqueeze(1), (fg - probas).abs(), torch.full_like(probas, -1.))
+    errors_sorted, perm = torch.sort(errors, -1, descending=True)
+    fg_sorted = fg.gather(-1, perm)
+    valid_sorted = valid.unsqueeze(1).expand_as(fg).gather(-1, perm).float()
+    losses = (errors_sorted * lovasz_grad_batched(fg_sorted, valid_sorted)).sum(-1)
+
+    if classes == 'present':
+        weight = fg.sum(-1) > 0
+    elif classes == 'all':
+        weight = valid.any(-1, keepdim=True).expand(-1, C)
+    else:
+        weight = torch.zeros_like(losses, dtype=torch.bool)
+        weight[:, classes] = valid.any(-1, keepdim=True)
+    weight = weight.float()
+    losses = (losses * weight).sum(-1) / weight.sum(-1).clamp(min=1.)
+    return losses.mean()
+
+
 def lovasz_softmax_flat(probas, labels, classes='present'):
     """
     Multi-class Lovasz-Softmax loss
@@ -0,0 +1,24 @@
+import numpy as np
+
+
+class LazyMemmap(object):
+    # the file is mapped on first access and never pickled,
+    # so that every data loader worker maps it on its own
+    def __init__(self, path):
+        self.path = path
+        self.array = None
+
+    def __len__(self):
+        return len(self.open())
+
+    def __getitem__(self, key):
+        return self.open()[key]
+
+    def __getstate__(self):
+        return {'path': self.path, 'array': None}
+
+    def open(self):
+        if self.array is None:
+            self.array = np.load(self.path, mmap_mode='r')
+
+        return self.array
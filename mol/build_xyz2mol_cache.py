@@ -0,0 +1,76 @@
+import glob
+import os
+import signal
+from functools import partial
+from multiprocessing import Pool
+
+import click
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from mol.dataset import load_bond_orders, save_bond_orders
+from mol.xyz2mol import canonical_smiles, read_xyz_file, xyz2mol_and_BO
+
+
+class ConversionTimeout(Exception):
+    pass
+
+
+@click.command()
+@click.option('--structures-path', type=click.Path(), default='./data/mol/structures')
+@click.option('--cache-path', type=click.Path(), default='./data/mol/xyz2mol')
+@click.option('--timeout', type=click.INT, default=60)
+@click.option('--quick/--no-quick', default=True)
+@click.option('--workers', type=click.INT, default=os.cpu_count())
+def main(structures_path, cache_path, timeout, quick, workers):
+    names = sorted(os.path.splitext(os.path.basename(path))[0]
+                   for path in glob.glob(os.path.join(structures_path, '*.xyz')))
+
+    # previously converted molecules are kept, failed ones are retried
+    results = {}
+    if os.path.exists(os.path.join(cache_path, 'names.npy')):
+        cached_names, smiles, num_atoms, bond_orders = load_bond_orders(cache_path)
+        offsets = np.concatenate([[0], np.cumsum(num_atoms**2)])
+        for i, name in enumerate(cached_names):
+            results[name] = smiles[i], bond_orders[offsets[i]:offsets[i + 1]].reshape(num_atoms[i], num_atoms[i])
+    names = [name for name in names if name not in results]
+
+    failures = []
+    with Pool(workers) as pool:
+        convert = partial(convert_structure, structures_path=structures_path, timeout=timeout, quick=quick)
+        results_iter = pool.imap_unordered(convert, names, chunksize=16)
+        for name, smiles, bond_order, error in tqdm(results_iter, total=len(names)):
+            if error is None:
+                results[name] = smiles, bond_order
+            else:
+                failures.append((name, error))
+
+    names = sorted(results)
+    save_bond_orders(cache_path, names, [results[name][0] for name in names], [results[name][1] for name in names])
+    pd.DataFrame(failures, columns=['molecule_name', 'error']) \
+        .to_csv(os.path.join(cache_path, 'failures.csv'), index=False)
+    print('converted: {}, failed: {}'.format(len(names), len(failures)))
+
+
+def convert_structure(name, structures_path, timeout, quick):
+    # the valence combination search can explode for some molecules, so every conversion gets an alarm
+    signal.signal(signal.SIGALRM, raise_timeout)
+    signal.alarm(timeout)
+    try:
+        atoms, charge, xyz = read_xyz_file(os.path.join(structures_path, '{}.xyz'.format(name)))
+        mol, bond_order = xyz2mol_and_BO(atoms, charge, xyz, charged_fragments=True, quick=quick)
+
+        return name, canonical_smiles(mol), np.asarray(bond_order, dtype=np.int8), None
+    except Exception as e:
+        return name, None, None, '{}: {}'.format(type(e).__name__, e)
+    finally:
+        signal.alarm(0)
+
+
+def raise_timeout(signum, frame):
+    raise ConversionTimeout('conversion took too long')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,13 @@
+import os
+
+import numpy as np
+import torch
 import torch.utils.data
+from torch_geometric.data import Data
+
+from memmap import LazyMemmap
+
+FIELDS = ['x', 'edge_index', 'edge_attr', 'y', 'u']
 
 
 class Dataset(torch.utils.data.Dataset):
@@ -10,3 +19,102 @@ class Dataset(torch.utils.data.Dataset):
 
     def __getitem__(self, item):
         return self.graphs[item]
+
+
+class PackedGraphs(object):
+    def __init__(self, path):
+        self.path = path
+        self.names = np.load(os.path.join(path, 'names.npy'))
+        self.arrays = {
+            k: LazyMemmap(os.path.join(path, '{}.npy'.format(k)))
+            for k in [*FIELDS, 'node_offsets', 'edge_offsets']}
+
+    def __len__(self):
+        return len(self.names)
+
+    def collate(self, indices):
+        indices = np.asarray(indices)
+
+        node_starts, node_ends = self.arrays['node_offsets'][indices], self.arrays['node_offsets'][indices + 1]
+        edge_starts, edge_ends = self.arrays['edge_offsets'][indices], self.arrays['edge_offsets'][indices + 1]
+        num_nodes = node_ends - node_starts
+        num_edges = edge_ends - edge_starts
+
+        node_index = concat_ranges(node_starts, num_nodes)
+        edge_index = concat_ranges(edge_starts, num_edges)
+
+        # edge indices are stored per molecule, shift them to the position of the molecule in the batch
+        shift = np.repeat(np.cumsum(num_nodes) - num_nodes, num_edges)
+
+        return Data(
+            x=torch.from_numpy(self.arrays['x'][node_index]),
+            edge_index=torch.from_numpy((self.arrays['edge_index'][edge_index] + shift.reshape(-1, 1)).T).long(),
+            edge_attr=torch.from_numpy(self.arrays['edge_attr'][edge_index]),
+            y=torch.from_numpy(self.arrays['y'][edge_index]),
+            u=torch.from_numpy(self.arrays['u'][indices]),
+            batch=torch.from_numpy(np.repeat(np.arange(len(indices)), num_nodes)))
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    def __init__(self, graphs, indices):
+        self.graphs = graphs
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, item):
+        return self.indices[item]
+
+    def collate(self, indices):
+        return self.graphs.collate(indices)
+
+
+def save_packed_graphs(path, names, graphs):
+    num_nodes = np.array([len(graph['x']) for graph in graphs])
+    num_edges = np.array([len(graph['edge_index']) for graph in graphs])
+    arrays = {k: np.concatenate([graph[k] for graph in graphs], 0) for k in FIELDS}
+
+    save_packed_arrays(path, names, num_nodes, num_edges, arrays)
+
+
+def save_packed_arrays(path, names, num_nodes, num_edges, arrays):
+    os.makedirs(path, exist_ok=True)
+
+    np.save(os.path.join(path, 'node_offsets.npy'), np.concatenate([[0], np.cumsum(num_nodes)]))
+    np.save(os.path.join(path, 'edge_offsets.npy'), np.concatenate([[0], np.cumsum(num_edges)]))
+
+    for k in FIELDS:
+        array = arrays[k].astype(np.int32 if k == 'edge_index' else np.float32)
+        np.save(os.path.join(path, '{}.npy'.format(k)), array)
+
+    np.save(os.path.join(path, 'names.npy'), np.array(names))
+
+
+def load_bond_orders(path):
+    # cache written by mol/build_xyz2mol_cache.py, bond order matrices are stored flattened one after another
+    names = np.load(os.path.join(path, 'names.npy'))
+    num_atoms = np.load(os.path.join(path, 'num_atoms.npy'))
+    bond_orders = np.load(os.path.join(path, 'bond_orders.npy'), mmap_mode='r')
+    smiles = np.load(os.path.join(path, 'smiles.npy'))
+
+    return names, smiles, num_atoms, bond_orders
+
+
+def save_bond_orders(path, names, smiles, bond_orders):
+    os.makedirs(path, exist_ok=True)
+
+    np.save(os.path.join(path, 'smiles.npy'), np.array(smiles))
+    np.save(os.path.join(path, 'num_atoms.npy'), np.array([len(bo) for bo in bond_orders], dtype=np.int64))
+    np.save(
+        os.path.join(path, 'bond_orders.npy'),
+        np.concatenate([np.zeros(0), *[np.reshape(bo, -1) for bo in bond_orders]]).astype(np.int8))
+
+    np.save(os.path.join(path, 'names.npy'), np.array(names))
+
+
+def concat_ranges(starts, lengths):
+    index = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    index += np.arange(lengths.sum())
+
+    return index
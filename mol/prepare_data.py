@@ -1,41 +1,75 @@
 from tqdm import tqdm
-from functools import partial
 import pandas as pd
 from multiprocessing import Pool
-import ase.io
 import ase.data
-import torch
 import os
-from torch_geometric.data import Data
 import numpy as np
 
+from mol.dataset import load_bond_orders, save_packed_arrays
+
 structures_path = './data/mol/structures'
+packed_path = './data/mol/packed'
+xyz2mol_path = './data/mol/xyz2mol'
+
 
+def load_structures(names):
+    # parses plain .xyz files into flat buffers, which are much cheaper to send back than ase.Atoms
+    num_nodes = np.zeros(len(names), dtype=np.int64)
+    numbers = []
+    positions = []
+    for k, name in enumerate(names):
+        with open(os.path.join(structures_path, '{}.xyz'.format(name))) as f:
+            lines = f.read().splitlines()
+        num_nodes[k] = int(lines[0])
+        atoms = ' '.join(lines[2:2 + num_nodes[k]]).split()
+        numbers.extend(ase.data.atomic_numbers[s] for s in atoms[0::4])
+        positions.append(np.array(atoms).reshape(-1, 4)[:, 1:].astype(np.float64))
 
-def load_mol(name):
-    return ase.io.read(os.path.join(structures_path, '{}.xyz'.format(name)))
+    return num_nodes, np.array(numbers, dtype=np.uint8), np.concatenate(positions, 0)
 
 
-def graph_to_data(pair, symbol_to_index, bond_to_index):
-    mol_name, (nodes, edges) = pair
+def load_all_structures(names, num_workers, chunk_size=1000):
+    chunks = [names[i:i + chunk_size] for i in range(0, len(names), chunk_size)]
+    with Pool(num_workers) as pool:
+        chunks = list(tqdm(pool.imap(load_structures, chunks), total=len(chunks), desc='loading nodes'))
+    num_nodes, numbers, positions = zip(*chunks)
+
+    return np.concatenate(num_nodes), np.concatenate(numbers), np.concatenate(positions, 0)
+
+
+def load_edges(names):
+    edges = pd.read_csv('./data/mol/train.csv')
+    contribs = pd.read_csv(
+        './data/mol/scalar_coupling_contributions.csv',
+        usecols=['molecule_name', 'atom_index_0', 'atom_index_1', 'fc', 'sd', 'pso', 'dso'])
+    edges = edges.merge(contribs, on=['molecule_name', 'atom_index_0', 'atom_index_1'], how='left', sort=False)
 
-    num_nodes = len(nodes)
-    num_edges = len(edges)
+    return group_edges(edges, names)
+
+
+def build_graphs(numbers, positions, num_nodes, edges, num_edges, bond_order, symbol_to_index, bond_to_index):
+    num_graphs = len(num_nodes)
+    node_offsets = np.cumsum(num_nodes) - num_nodes
+    node_graph = np.repeat(np.arange(num_graphs), num_nodes)
+    edge_graph = np.repeat(np.arange(num_graphs), num_edges)
 
     # TODO: node mean stats
 
     # building x
-    x = torch.zeros(num_nodes, 8)  # symbol_type, x, y, z, am, cr, gsmm, vdwr
-    for node in nodes:
-        x[node.index, 0] = symbol_to_index[node.symbol]
-        x[node.index, 1:4] = torch.tensor([node.x, node.y, node.z])
-        features = [
-            ase.data.atomic_masses,
-            ase.data.covalent_radii,
-            ase.data.ground_state_magnetic_moments,
-            ase.data.vdw_radii
-        ]
-        x[node.index, 4:] = torch.tensor([f[node.number] for f in features])
+    symbol_table = np.full(len(ase.data.chemical_symbols), -1)
+    for s, i in symbol_to_index.items():
+        symbol_table[ase.data.atomic_numbers[s]] = i
+    features = [
+        symbol_table,
+        ase.data.atomic_masses,
+        ase.data.covalent_radii,
+        ase.data.ground_state_magnetic_moments,
+        ase.data.vdw_radii
+    ]
+    x = np.zeros((len(numbers), 8))  # symbol_type, x, y, z, am, cr, gsmm, vdwr
+    x[:, 0] = features[0][numbers]
+    x[:, 1:4] = positions
+    x[:, 4:] = np.stack([f[numbers] for f in features[1:]], 1)
 
     # extracting fields
     i = edges['atom_index_0'].values
@@ -44,73 +78,99 @@ def graph_to_data(pair, symbol_to_index, bond_to_index):
     coupling = edges[['scalar_coupling_constant', 'fc', 'sd', 'pso', 'dso']].values
 
     # building edge_index
-    edge_index = torch.tensor(np.array([i, j]))
+    edge_index = np.stack([i, j], 1)
 
     # building edge_attr
-    edge_attr = torch.zeros(num_edges, 5)  # bond_type, dist, x_dist, y_dist, z_dist
-    edge_attr[:, 0] = torch.tensor([bond_to_index[b] for b in bond])
-    dist = np.linalg.norm(nodes.positions[i] - nodes.positions[j], axis=-1)
-    edge_attr[:, 1] = torch.tensor(dist)
-    dist = np.abs(nodes.positions[i] - nodes.positions[j])
-    edge_attr[:, 2:] = torch.tensor(dist)
+    delta = positions[node_offsets[edge_graph] + i] - positions[node_offsets[edge_graph] + j]
+    dist = np.linalg.norm(delta, axis=-1)
+    edge_attr = np.zeros((len(edges), 6))  # bond_type, dist, x_dist, y_dist, z_dist, bond_order
+    edge_attr[:, 0] = pd.Series(bond).map(bond_to_index).values
+    edge_attr[:, 1] = dist
+    edge_attr[:, 2:5] = np.abs(delta)
+    edge_attr[:, 5] = bond_order
 
     # building y
-    y = torch.tensor(coupling)
+    y = coupling
 
     # building u
-    u = [*nodes.positions.mean(0), *nodes.positions.std(0)]
-    dist = np.linalg.norm(nodes.positions[i] - nodes.positions[j], axis=-1)
-    u = [*u, dist.mean(), dist.std()]
-    dist = np.abs(nodes.positions[i] - nodes.positions[j])
-    u = [*u, *dist.mean(0), *dist.std(0)]
-    u = torch.tensor([u])
-    u[u != u] = 0.
+    u = np.concatenate([
+        *segment_mean_std(positions, node_graph, num_graphs),
+        *segment_mean_std(dist, edge_graph, num_graphs),
+        *segment_mean_std(np.abs(delta), edge_graph, num_graphs),
+    ], 1)
 
-    data = Data(
-        x=x.float(),
-        edge_index=edge_index.long(),
-        edge_attr=edge_attr.float(),
-        y=y.float(),
-        u=u.float())
+    return {
+        'x': x,
+        'edge_index': edge_index,
+        'edge_attr': edge_attr,
+        'y': y,
+        'u': u,
+    }
 
-    path = './data/mol/graphs/{}.pth'.format(mol_name)
-    torch.save(data, path)
 
+def segment_mean_std(values, segments, num_segments):
+    # population mean and std of values within each segment, 0 for empty segments
+    values = values.reshape(len(values), -1)
+    count = np.bincount(segments, minlength=num_segments).reshape(-1, 1)
+    count = np.maximum(count, 1)
 
-def collect_edges(mol_name, edges):
-    return edges[edges['molecule_name'] == mol_name]
+    mean = np.stack([np.bincount(segments, v, minlength=num_segments) for v in values.T], 1) / count
+    var = np.stack([np.bincount(segments, v, minlength=num_segments) for v in (values - mean[segments]).T ** 2], 1)
+    std = np.sqrt(var / count)
 
+    return mean, std
 
-def main():
-    num_workers = os.cpu_count()
-    mol_names = pd.read_csv('./data/mol/dipole_moments.csv')['molecule_name'].values
 
-    with Pool(num_workers) as pool:
-        nodes = pool.map(load_mol, tqdm(mol_names, desc='loading nodes'))
+def join_bond_orders(mol_names, num_nodes, edges, num_edges, path):
+    # bond order between the coupled atoms from the xyz2mol cache, 0 for unbonded pairs and unconverted molecules
+    bond_order = np.zeros(len(edges))
+    if not os.path.exists(os.path.join(path, 'names.npy')):
+        return bond_order
 
-    edges = pd.read_csv('./data/mol/train.csv')
-    contribs = pd.read_csv('./data/mol/scalar_coupling_contributions.csv')
-    edges[['fc', 'sd', 'pso', 'dso']] = contribs[['fc', 'sd', 'pso', 'dso']]
-    edges = edges.set_index('molecule_name')
-    edges = [edges.loc[[mol_name]] for mol_name in tqdm(mol_names, desc='loading edges')]
+    names, _, num_atoms, bond_orders = load_bond_orders(path)
+    offsets = np.concatenate([[0], np.cumsum(num_atoms**2)])
+
+    index = pd.Index(names).get_indexer(mol_names)
+    index = np.repeat(index, num_edges)
+    valid = index >= 0
+    valid[valid] = num_atoms[index[valid]] == np.repeat(num_nodes, num_edges)[valid]
+
+    index = index[valid]
+    i = edges['atom_index_0'].values[valid]
+    j = edges['atom_index_1'].values[valid]
+    bond_order[valid] = bond_orders[offsets[index] + i * num_atoms[index] + j]
+
+    return bond_order
+
+
+def group_edges(edges, mol_names):
+    # single stable sort by molecule, keeping the original edge order within each molecule
+    codes = pd.Index(mol_names).get_indexer(edges['molecule_name'])
+    order = np.argsort(codes, kind='stable')
+    order = order[codes[order] >= 0]
+    edges = edges.iloc[order].reset_index(drop=True)
+    num_edges = np.bincount(codes[order], minlength=len(mol_names))
 
-    graphs = {mol_name: (ns, es) for mol_name, ns, es in zip(mol_names, nodes, edges)}
+    return edges, num_edges
 
-    symbol_to_index = set()
-    bond_to_index = set()
-    for nodes, edges in tqdm(graphs.values(), 'building mapping'):
-        symbol_to_index.update(node.symbol for node in nodes)
-        bond_to_index.update(edges['type'].values)
 
-    symbol_to_index = {s: i for i, s in enumerate(sorted(symbol_to_index))}
-    bond_to_index = {b: i for i, b in enumerate(sorted(bond_to_index))}
+def main():
+    num_workers = os.cpu_count()
+    mol_names = pd.read_csv('./data/mol/dipole_moments.csv')['molecule_name'].values
+
+    num_nodes, numbers, positions = load_all_structures(mol_names, num_workers)
+    edges, num_edges = load_edges(mol_names)
+    bond_order = join_bond_orders(mol_names, num_nodes, edges, num_edges, xyz2mol_path)
+
+    symbols = sorted(ase.data.chemical_symbols[n] for n in np.unique(numbers))
+    symbol_to_index = {s: i for i, s in enumerate(symbols)}
+    bond_to_index = {b: i for i, b in enumerate(sorted(edges['type'].unique()))}
     print('symbol_to_index', symbol_to_index)
     print('bond_to_index', bond_to_index)
 
-    with Pool(num_workers) as pool:
-        pool.map(
-            partial(graph_to_data, symbol_to_index=symbol_to_index, bond_to_index=bond_to_index),
-            tqdm(graphs.items(), desc='saving data'))
+    graphs = build_graphs(
+        numbers, positions, num_nodes, edges, num_edges, bond_order, symbol_to_index, bond_to_index)
+    save_packed_arrays(packed_path, mol_names, num_nodes, num_edges, graphs)
 
 
 if __name__ == '__main__':
@@ -3,13 +3,11 @@ import os
 
 import click
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn as nn
 import torch.utils.data
 from sklearn.model_selection import KFold
 from tensorboardX import SummaryWriter
-from torch_geometric.data import DataLoader
 from torch_geometric.nn import MetaLayer
 from torch_scatter import scatter_mean
 from tqdm import tqdm
@@ -18,6 +16,7 @@ import lr_scheduler_wrapper
 import utils
 from config import Config
 from lr_scheduler import OneCycleScheduler
+from mol.dataset import PackedDataset, PackedGraphs
 
 # TODO: bidirectional edges
 # TODO: ohem
@@ -25,23 +24,10 @@ from lr_scheduler import OneCycleScheduler
 
 
 FOLDS = list(range(1, 5 + 1))
+NUM_GROUPS = 8
 DEVICE = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
 
-class Dataset(torch.utils.data.Dataset):
-    def __init__(self, data):
-        self.data = data
-
-    def __len__(self):
-        return len(self.data)
-
-    def __getitem__(self, item):
-        id = self.data[item]
-        path = './data/mol/graphs/{}.pth'.format(id)
-
-        return torch.load(path)
-
-
 # class ReLU(nn.SELU):
 #     pass
 
@@ -138,16 +124,16 @@ class Model(nn.Module):
 
         # TODO: rename
         self.nodes = nn.Embedding(5, 8)
-        self.edges = nn.Embedding(8, 8)
+        self.edges = nn.Embedding(NUM_GROUPS, 8)
 
         self.x_norm = nn.BatchNorm1d(8 + 7)
-        self.edge_attr_norm = nn.BatchNorm1d(8 + 4)
+        self.edge_attr_norm = nn.BatchNorm1d(8 + 5)
         self.u_norm = nn.BatchNorm1d(14)
 
         self.layers = nn.ModuleList([
             Layer(
                 node_features=(8 + 7, model.size),
-                edge_features=(8 + 4, model.size),
+                edge_features=(8 + 5, model.size),
                 global_features=(14, model.size)),
             *[Layer(
                 node_features=(model.size, model.size),
@@ -223,23 +209,25 @@ def indices_for_fold(fold, dataset_size, seed):
     return train_indices, eval_indices
 
 
-def train_fold(fold, train_eval_data, args, config):
-    train_indices, eval_indices = indices_for_fold(fold, len(train_eval_data), seed=config.seed)
-    train_dataset = Dataset([train_eval_data[i] for i in train_indices])
-    eval_dataset = Dataset([train_eval_data[i] for i in eval_indices])
+def train_fold(fold, graphs, args, config):
+    train_indices, eval_indices = indices_for_fold(fold, len(graphs), seed=config.seed)
+    train_dataset = PackedDataset(graphs, train_indices)
+    eval_dataset = PackedDataset(graphs, eval_indices)
 
-    train_data_loader = DataLoader(
+    train_data_loader = torch.utils.data.DataLoader(
         train_dataset,
         batch_size=config.batch_size,
         drop_last=True,
         shuffle=True,
         num_workers=args['workers'],
+        collate_fn=train_dataset.collate,
         worker_init_fn=worker_init_fn)
 
-    eval_data_loader = DataLoader(
+    eval_data_loader = torch.utils.data.DataLoader(
         eval_dataset,
         batch_size=config.batch_size,
         num_workers=args['workers'],
+        collate_fn=eval_dataset.collate,
         worker_init_fn=worker_init_fn)
 
     model = Model(config.model)
@@ -308,29 +296,62 @@ def train_fold(fold, train_eval_data, args, config):
             torch.save(model.state_dict(), os.path.join(args['experiment_path'], 'model_{}.pth'.format(fold)))
 
 
-def compute_loss(input, target, groups):
+def compute_group_error(input, target, groups, num_groups=NUM_GROUPS):
     groups = groups.long()
 
     error = torch.abs(input - target)
-    error = scatter_mean(error, groups, dim=0)
+    error = torch.zeros(num_groups, error.size(1), dtype=error.dtype, device=error.device).index_add_(0, groups, error)
+    count = torch.bincount(groups, minlength=num_groups)
+
+    return error, count
+
+
+def compute_loss(input, target, groups):
+    error, count = compute_group_error(input, target, groups)
+    present = count > 0
+
+    error = error[present] / count[present].unsqueeze(1).to(error.dtype)
     error = torch.clamp(error, 1e-9)
     loss = error.log().mean()
 
     return loss
 
 
-def compute_score(input, target, groups):
-    input = input[:, 0]
-    target = target[:, 0]
+class GroupLogMAE(object):
+    # streams per coupling type sums of absolute errors for every target head,
+    # so the score is computed at the end of an epoch without keeping predictions around
+    def __init__(self, num_groups=NUM_GROUPS):
+        self.num_groups = num_groups
+        self.reset()
 
-    groups = groups.long()
+    def compute(self):
+        # competition score, only the scalar coupling constant head is scored
+        return self.compute_per_group()[self.count > 0, 0].mean().item()
 
-    error = torch.abs(input - target)
-    error = scatter_mean(error, groups)
-    error = torch.clamp(error, 1e-9)
-    loss = error.log().mean()
+    def compute_per_group(self):
+        error = self.error / self.count.unsqueeze(1).clamp(min=1).to(self.error.dtype)
+        error = torch.clamp(error, 1e-9)
 
-    return loss
+        return error.log()
+
+    def update(self, input, target, groups):
+        error, count = compute_group_error(input, target, groups, num_groups=self.num_groups)
+
+        if self.error is None:
+            self.error, self.count = error, count
+        else:
+            self.error += error
+            self.count += count
+
+    def reset(self):
+        self.error = None
+        self.count = None
+
+    def compute_and_reset(self):
+        value = self.compute()
+        self.reset()
+
+        return value
 
 
 def train_epoch(model, optimizer, scheduler, data_loader, fold, epoch, args, config):
@@ -368,34 +389,29 @@ def eval_epoch(model, data_loader, fold, epoch, args, config):
 
     metrics = {
         'loss': utils.Mean(),
+        'score': GroupLogMAE(),
     }
 
-    predictions = []
-    targets = []
-    groups = []
     model.eval()
     with torch.no_grad():
         for batch in tqdm(data_loader, desc='epoch {} evaluation'.format(epoch)):
             batch = batch.to(DEVICE)
             logits = model(batch)
 
-            targets.append(batch.y)
-            predictions.append(logits)
-            groups.append(batch.edge_attr[:, 0])
-
             loss = compute_loss(input=logits, target=batch.y, groups=batch.edge_attr[:, 0])
             metrics['loss'].update(loss.data.cpu().numpy())
+            metrics['score'].update(input=logits, target=batch.y, groups=batch.edge_attr[:, 0])
 
         loss = metrics['loss'].compute_and_reset()
-
-        predictions = torch.cat(predictions, 0)
-        targets = torch.cat(targets, 0)
-        groups = torch.cat(groups, 0)
-        score = compute_score(input=predictions, target=targets, groups=groups)
+        per_group = metrics['score'].compute_per_group()
+        present = metrics['score'].count > 0
+        score = metrics['score'].compute_and_reset()
 
         print('[FOLD {}][EPOCH {}][EVAL] loss: {:.4f}, score: {:.4f}'.format(fold, epoch, loss, score))
         writer.add_scalar('loss', loss, global_step=epoch)
         writer.add_scalar('score', score, global_step=epoch)
+        for i in present.nonzero().view(-1).tolist():
+            writer.add_scalar('score/type_{}'.format(i), per_group[i, 0], global_step=epoch)
         writer.add_histogram('true', batch.y, global_step=epoch)
         writer.add_histogram('pred', logits, global_step=epoch)
 
@@ -409,9 +425,9 @@ def eval_epoch(model, data_loader, fold, epoch, args, config):
 def main(**args):
     config = Config.from_yaml(args['config_path'])
 
-    mol_names = pd.read_csv('./data/mol/dipole_moments.csv')['molecule_name'].values
-    print(len(mol_names))
-    train_fold(1, mol_names, args=args, config=config)
+    graphs = PackedGraphs('./data/mol/packed')
+    print(len(graphs))
+    train_fold(1, graphs, args=args, config=config)
 
 
 if __name__ == '__main__':
@@ -5,10 +5,12 @@
 #
 from rdkit import Chem
 from rdkit.Chem import AllChem
+import functools
 import itertools
 from rdkit.Chem import rdmolops
 from collections import defaultdict
 import copy
+import numpy as np
 import networkx as nx  # uncomment if you don't want to use "quick"/install networkx
 
 global __ATOM_LIST__
@@ -41,7 +43,7 @@ def getUA(maxValence_list, valence_list):
     return UA, DU
 
 
-def get_BO(AC, UA, DU, valences, UA_pairs, quick):
+def get_BO(AC, UA, DU, valences, UA_pairs, quick, cache=None):
     BO = AC.copy()
     DU_save = []
 
@@ -53,7 +55,7 @@ def get_BO(AC, UA, DU, valences, UA_pairs, quick):
         BO_valence = list(BO.sum(axis=1))
         DU_save = copy.copy(DU)
         UA, DU = getUA(valences, BO_valence)
-        UA_pairs = get_UA_pairs(UA, AC, quick)[0]
+        UA_pairs = get_UA_pairs(UA, AC, quick, cache=cache)[0]
 
     return BO
 
@@ -209,17 +211,21 @@ def set_atomic_radicals(mol, atomicNumList, atomic_valence_electrons, BO_valence
 
 
 def get_bonds(UA, AC):
-    bonds = []
+    UA = np.asarray(UA, dtype=int)
+    i, j = np.nonzero(np.triu(AC[np.ix_(UA, UA)] == 1, 1))
+    i, j = UA[i], UA[j]
 
-    for k, i in enumerate(UA):
-        for j in UA[k + 1:]:
-            if AC[i, j] == 1:
-                bonds.append(tuple(sorted([i, j])))
+    return [(a, b) if a < b else (b, a) for a, b in zip(i.tolist(), j.tolist())]
 
-    return bonds
 
+def get_UA_pairs(UA, AC, quick, cache=None):
+    # pairs only depend on UA for a fixed AC, and the same UA comes up for many valence combinations
+    if cache is not None:
+        key = (tuple(UA), quick)
+        if key not in cache:
+            cache[key] = get_UA_pairs(UA, AC, quick)
+        return cache[key]
 
-def get_UA_pairs(UA, AC, quick):
     bonds = get_bonds(UA, AC)
     if len(bonds) == 0:
         return [()]
@@ -230,20 +236,35 @@ def get_UA_pairs(UA, AC, quick):
         UA_pairs = [list(nx.max_weight_matching(G))]
         return UA_pairs
 
-    max_atoms_in_combo = 0
-    UA_pairs = [()]
-    for combo in list(itertools.combinations(bonds, int(len(UA) / 2))):
-        flat_list = [item for sublist in combo for item in sublist]
-        atoms_in_combo = len(set(flat_list))
-        if atoms_in_combo > max_atoms_in_combo:
-            max_atoms_in_combo = atoms_in_combo
-            UA_pairs = [combo]
-        #           if quick and max_atoms_in_combo == 2*int(len(UA)/2):
-        #               return UA_pairs
-        elif atoms_in_combo == max_atoms_in_combo:
-            UA_pairs.append(combo)
+    return max_cover_combinations(bonds, int(len(UA) / 2))
 
-    return UA_pairs
+
+def max_cover_combinations(bonds, size):
+    # all combinations of `size` bonds covering the largest number of distinct atoms, in itertools.combinations
+    # order. branches are pruned as soon as they cannot reach the best cover found so far,
+    # every new bond adds at most 2 atoms
+    best = [0, [()]]
+
+    def search(start, combo, atoms):
+        if len(combo) == size:
+            if len(atoms) > best[0]:
+                best[0], best[1] = len(atoms), [tuple(combo)]
+            elif len(atoms) == best[0]:
+                best[1].append(tuple(combo))
+            return
+
+        for k in range(start, len(bonds) - (size - len(combo)) + 1):
+            if len(atoms) + 2 * (size - len(combo)) < best[0]:
+                return
+            i, j = bonds[k]
+            combo.append(bonds[k])
+            search(k + 1, combo, atoms | {i, j})
+            combo.pop()
+
+    if size > 0:
+        search(0, [], frozenset())
+
+    return best[1]
 
 
 def AC2BO(AC, atomicNumList, charge, charged_fragments, quick):
@@ -292,6 +313,7 @@ def AC2BO(AC, atomicNumList, charge, charged_fragments, quick):
     # best_BO: Bcurr in Figure
     #
 
+    UA_pairs_cache = {}
     for valences in valences_list:
         AC_valence = list(AC.sum(axis=1))
         UA, DU_from_AC = getUA(valences, AC_valence)
@@ -300,9 +322,9 @@ def AC2BO(AC, atomicNumList, charge, charged_fragments, quick):
                                      charged_fragments):
             return AC, atomic_valence_electrons
 
-        UA_pairs_list = get_UA_pairs(UA, AC, quick)
+        UA_pairs_list = get_UA_pairs(UA, AC, quick, cache=UA_pairs_cache)
         for UA_pairs in UA_pairs_list:
-            BO = get_BO(AC, UA, DU_from_AC, valences, UA_pairs, quick)
+            BO = get_BO(AC, UA, DU_from_AC, valences, UA_pairs, quick, cache=UA_pairs_cache)
             if BO_is_OK(BO, AC, charge, DU_from_AC, atomic_valence_electrons, atomicNumList, charged_fragments):
                 return BO, atomic_valence_electrons
 
@@ -364,30 +386,27 @@ def read_xyz_file(filename):
     return atomicNumList, charge, xyz_coordinates
 
 
+@functools.lru_cache(maxsize=1)
+def covalent_radii():
+    pt = Chem.GetPeriodicTable()
+
+    return np.array([0.] + [pt.GetRcovalent(n) for n in range(1, len(__ATOM_LIST__) + 1)])
+
+
 def xyz2AC(atomicNumList, xyz):
-    import numpy as np
     mol = get_proto_mol(atomicNumList)
 
+    xyz = np.asarray(xyz, dtype=float)
     conf = Chem.Conformer(mol.GetNumAtoms())
     for i in range(mol.GetNumAtoms()):
-        conf.SetAtomPosition(i, (xyz[i][0], xyz[i][1], xyz[i][2]))
+        conf.SetAtomPosition(i, xyz[i].tolist())
     mol.AddConformer(conf)
 
-    dMat = Chem.Get3DDistanceMatrix(mol)
-    pt = Chem.GetPeriodicTable()
-
-    num_atoms = len(atomicNumList)
-    AC = np.zeros((num_atoms, num_atoms)).astype(int)
+    dMat = np.linalg.norm(xyz[:, None, :] - xyz[None, :, :], axis=-1)
+    Rcov = covalent_radii()[np.asarray(atomicNumList)] * 1.30
 
-    for i in range(num_atoms):
-        a_i = mol.GetAtomWithIdx(i)
-        Rcov_i = pt.GetRcovalent(a_i.GetAtomicNum()) * 1.30
-        for j in range(i + 1, num_atoms):
-            a_j = mol.GetAtomWithIdx(j)
-            Rcov_j = pt.GetRcovalent(a_j.GetAtomicNum()) * 1.30
-            if dMat[i, j] <= Rcov_i + Rcov_j:
-                AC[i, j] = 1
-                AC[j, i] = 1
+    AC = (dMat <= Rcov[:, None] + Rcov[None, :]).astype(int)
+    np.fill_diagonal(AC, 0)
 
     return AC, mol
 
@@ -402,17 +421,33 @@ def chiral_stereo_check(mol):
 
 
 def xyz2mol(atomicNumList, charge, xyz_coordinates, charged_fragments, quick):
+    new_mol, _ = xyz2mol_and_BO(atomicNumList, charge, xyz_coordinates, charged_fragments, quick)
+
+    return new_mol
+
+
+def xyz2mol_and_BO(atomicNumList, charge, xyz_coordinates, charged_fragments, quick):
     # Get atom connectivity (AC) matrix, list of atomic numbers, molecular charge,
     # and mol object with no connectivity information
     AC, mol = xyz2AC(atomicNumList, xyz_coordinates)
 
     # Convert AC to bond order matrix and add connectivity and charge info to mol object
-    new_mol = AC2mol(mol, AC, atomicNumList, charge, charged_fragments, quick)
+    BO, atomic_valence_electrons = AC2BO(AC, atomicNumList, charge, charged_fragments, quick)
+    new_mol = BO2mol(mol, BO, atomicNumList, atomic_valence_electrons, charge, charged_fragments)
 
     # Check for stereocenters and chiral centers
     new_mol = chiral_stereo_check(new_mol)
 
-    return new_mol
+    return new_mol, BO
+
+
+def canonical_smiles(mol):
+    # Canonical hack
+    smiles = Chem.MolToSmiles(mol, isomericSmiles=True)
+    m = Chem.MolFromSmiles(smiles)
+    smiles = Chem.MolToSmiles(m, isomericSmiles=True)
+
+    return smiles
 
 
 if __name__ == "__main__":
@@ -442,9 +477,6 @@ if __name__ == "__main__":
         writer = Chem.SDWriter(filename)
         writer.write(mol)
 
-    # Canonical hack
-    smiles = Chem.MolToSmiles(mol, isomericSmiles=True)
-    m = Chem.MolFromSmiles(smiles)
-    smiles = Chem.MolToSmiles(m, isomericSmiles=True)
+    smiles = canonical_smiles(mol)
 
     print(smiles)
@@ -35,22 +35,6 @@ parser.add_argument('--experiment-path', type=str, default='./tf_log/segmentatio
 parser.add_argument('--dataset-path', type=str, required=True)
 parser.add_argument('--restore-path', type=str)
 parser.add_argument('--workers', type=int, default=os.cpu_count())
-args = parser.parse_args()
-config = Config.from_yaml(args.config_path)
-shutil.copy(args.config_path, utils.mkdir(args.experiment_path))
-
-train_transform = T.Compose([
-    Resize(config.image_size),
-    RandomCrop(config.image_size),
-    ToTensor(),
-    Normalize(mean=MEAN, std=STD),
-])
-eval_transform = T.Compose([
-    Resize(config.image_size),
-    CenterCrop(config.image_size),
-    ToTensor(),
-    Normalize(mean=MEAN, std=STD),
-])
 
 
 class ADE20K(torch.utils.data.Dataset):
@@ -131,14 +115,13 @@ def worker_init_fn(_):
     utils.seed_python(torch.initial_seed() % 2**32)
 
 
-from losses import iou_loss
+from losses import label_iou_loss
 
 
 def compute_loss(input, target):
     input = input.softmax(1)
-    target = one_hot(target, NUM_CLASSES)
 
-    loss = iou_loss(input=input, target=target, axis=(2, 3))
+    loss = label_iou_loss(input=input, target=target.squeeze(1))
     loss = loss.mean(1)
 
     return loss
@@ -164,32 +147,51 @@ def draw_masks(input):
     return input
 
 
-def compute_metric(input, target):
-    def dice(input, target):
-        axis = (2, 3)
+def compute_confusion(input, target):
+    # per image confusion matrices (B, target, prediction), built with bincount over flattened label pairs
+    input = input.argmax(1).view(input.size(0), -1)
+    target = target.view(target.size(0), -1)
 
-        intersection = (input * target).sum(axis)
-        union = input.sum(axis) + target.sum(axis)
-        v = (2. * intersection) / union
-        v[v != v] = 0.
-        v = v.mean(1)
+    index = torch.arange(input.size(0), device=input.device).view(-1, 1)
+    index = (index * NUM_CLASSES + target) * NUM_CLASSES + input
+    confusion = torch.bincount(index.view(-1), minlength=input.size(0) * NUM_CLASSES**2)
+    confusion = confusion.view(input.size(0), NUM_CLASSES, NUM_CLASSES)
 
-        return v
+    return confusion
 
-    def iou(input, target):
-        axis = (2, 3)
 
-        intersection = (input * target).sum(axis)
-        union = input.sum(axis) + target.sum(axis) - intersection
-        v = intersection / union
-        v[v != v] = 0.
-        v = v.mean(1)
+def dice_iou_from_confusion(confusion):
+    # nan for classes present neither in target nor in prediction
+    confusion = confusion.float()
 
-        return v
+    intersection = confusion.diagonal(dim1=-2, dim2=-1)
+    union = confusion.sum(-1) + confusion.sum(-2)
+    dice = (2. * intersection) / union
+    iou = intersection / (union - intersection)
+
+    return dice, iou
+
+
+def compute_metric(confusion):
+    dice, iou = dice_iou_from_confusion(confusion)
+    dice[dice != dice] = 0.
+    iou[iou != iou] = 0.
+
+    metric = {
+        'dice': dice.mean(1),
+        'iou': iou.mean(1),
+    }
+
+    return metric
+
+
+def compute_dataset_metric(confusion):
+    dice, iou = dice_iou_from_confusion(confusion)
+    present = dice == dice
 
     metric = {
-        'dice': dice(input=one_hot(input.argmax(1, keepdim=True), NUM_CLASSES), target=one_hot(target, NUM_CLASSES)),
-        'iou': iou(input=one_hot(input.argmax(1, keepdim=True), NUM_CLASSES), target=one_hot(target, NUM_CLASSES)),
+        'dataset_dice': dice[present].mean().item(),
+        'dataset_iou': iou[present].mean().item(),
     }
 
     return metric
@@ -218,8 +220,8 @@ def build_optimizer(optimizer, parameters):
         raise AssertionError('invalid OPT {}'.format(optimizer.type))
 
 
-def train_epoch(model, optimizer, scheduler, data_loader, epoch):
-    writer = SummaryWriter(os.path.join(args.experiment_path, 'train'))
+def train_epoch(model, optimizer, scheduler, data_loader, epoch, experiment_path):
+    writer = SummaryWriter(os.path.join(experiment_path, 'train'))
 
     metrics = {
         'loss': utils.Mean(),
@@ -257,8 +259,8 @@ def train_epoch(model, optimizer, scheduler, data_loader, epoch):
             masks_pred, nrow=math.ceil(math.sqrt(masks_pred.size(0))), normalize=False), global_step=epoch)
 
 
-def eval_epoch(model, data_loader, epoch):
-    writer = SummaryWriter(os.path.join(args.experiment_path, 'eval'))
+def eval_epoch(model, data_loader, epoch, experiment_path):
+    writer = SummaryWriter(os.path.join(experiment_path, 'eval'))
 
     metrics = {
         'loss': utils.Mean(),
@@ -266,6 +268,7 @@ def eval_epoch(model, data_loader, epoch):
         'iou': utils.Mean(),
     }
 
+    total_confusion = 0
     model.eval()
     with torch.no_grad():
         for images, labels in tqdm(data_loader, desc='epoch {} evaluation'.format(epoch)):
@@ -275,11 +278,14 @@ def eval_epoch(model, data_loader, epoch):
             loss = compute_loss(input=logits, target=labels)
             metrics['loss'].update(loss.data.cpu().numpy())
 
-            metric = compute_metric(input=logits, target=labels)
+            confusion = compute_confusion(input=logits, target=labels)
+            total_confusion += confusion.sum(0)
+            metric = compute_metric(confusion)
             for k in metric:
                 metrics[k].update(metric[k].data.cpu().numpy())
 
         metrics = {k: metrics[k].compute_and_reset() for k in metrics}
+        metrics.update(compute_dataset_metric(total_confusion))
         masks_true = draw_masks(labels)
         masks_pred = draw_masks(logits.argmax(1, keepdim=True))
 
@@ -297,7 +303,20 @@ def eval_epoch(model, data_loader, epoch):
         return metrics
 
 
-def train():
+def train(args, config):
+    train_transform = T.Compose([
+        Resize(config.image_size),
+        RandomCrop(config.image_size),
+        ToTensor(),
+        Normalize(mean=MEAN, std=STD),
+    ])
+    eval_transform = T.Compose([
+        Resize(config.image_size),
+        CenterCrop(config.image_size),
+        ToTensor(),
+        Normalize(mean=MEAN, std=STD),
+    ])
+
     train_dataset = ADE20K(args.dataset_path, train=True, transform=train_transform)
     train_dataset = torch.utils.data.Subset(
         train_dataset, np.random.permutation(len(train_dataset))[:len(train_dataset) // 1])
@@ -347,12 +366,14 @@ def train():
             optimizer=optimizer,
             scheduler=scheduler,
             data_loader=train_data_loader,
-            epoch=epoch)
+            epoch=epoch,
+            experiment_path=args.experiment_path)
         gc.collect()
         metric = eval_epoch(
             model=model,
             data_loader=eval_data_loader,
-            epoch=epoch)
+            epoch=epoch,
+            experiment_path=args.experiment_path)
         gc.collect()
 
         scheduler.step_epoch()
@@ -362,9 +383,13 @@ def train():
 
 
 def main():
+    args = parser.parse_args()
+    config = Config.from_yaml(args.config_path)
+    shutil.copy(args.config_path, utils.mkdir(args.experiment_path))
+
     utils.seed_python(config.seed)
     utils.seed_torch(config.seed)
-    train()
+    train(args, config)
 
 
 if __name__ == '__main__':
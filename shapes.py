@@ -1,36 +1,35 @@
 import math
+import os
 import random
+from multiprocessing import Pool
 
+import click
 import cv2
 import numpy as np
 import torch
+import torch.utils.data
 from PIL import Image
+from tqdm import tqdm
+
+from memmap import LazyMemmap
+
+SHAPES = ['background', 'square', 'triangle', 'circle']
 
 
 # TODO: refactor
 
 
 class Shapes(torch.utils.data.Dataset):
-    def __init__(self, num_samples, image_size):
+    def __init__(self, num_samples, image_size, transform=None):
         self.num_samples = num_samples
         self.image_size = image_size
+        self.transform = transform
 
     def __len__(self):
         return self.num_samples
 
     def __getitem__(self, item):
-        bg_color, shapes = random_image(self.image_size)
-        bg_color = np.array(bg_color).reshape([1, 1, 3])
-
-        image = np.ones([*self.image_size, 3], dtype=np.uint8)
-        image = image * bg_color.astype(np.uint8)
-        for shape, color, dims in shapes:
-            image = draw_shape(image, shape, dims, color)
-
-        mask = np.zeros([*self.image_size], dtype=np.uint8)
-        for shape, _, dims in shapes:
-            color = ['background', 'square', 'triangle', 'circle'].index(shape)
-            mask = draw_shape(mask, shape, dims, color)
+        image, mask = render_image(self.image_size)
 
         image = Image.fromarray(image, mode='RGB')
         mask = Image.fromarray(mask, mode='L')
@@ -41,6 +40,78 @@ class Shapes(torch.utils.data.Dataset):
         return image, mask
 
 
+class ShapesStore(torch.utils.data.Dataset):
+    """Serves images and masks rendered by build_shapes_store."""
+
+    def __init__(self, path, transform=None):
+        self.path = path
+        self.transform = transform
+        self.images = LazyMemmap(os.path.join(path, 'images.npy'))
+        self.masks = LazyMemmap(os.path.join(path, 'masks.npy'))
+        self.num_samples = int(np.load(os.path.join(path, 'meta.npy'))[1])
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, item):
+        image = Image.fromarray(np.array(self.images[item]), mode='RGB')
+        mask = Image.fromarray(np.array(self.masks[item]), mode='L')
+
+        if self.transform is not None:
+            image, mask = self.transform((image, mask))
+
+        return image, mask
+
+
+def render_image(image_size, rng=random):
+    bg_color, shapes = random_image(image_size, rng=rng)
+    bg_color = np.array(bg_color).reshape([1, 1, 3])
+
+    image = np.ones([*image_size, 3], dtype=np.uint8)
+    image = image * bg_color.astype(np.uint8)
+    for shape, color, dims in shapes:
+        image = draw_shape(image, shape, dims, color)
+
+    mask = np.zeros([*image_size], dtype=np.uint8)
+    for shape, _, dims in shapes:
+        color = SHAPES.index(shape)
+        mask = draw_shape(mask, shape, dims, color)
+
+    return image, mask
+
+
+def render_batch(batch):
+    # every sample has its own generator, so the result does not depend on batching or worker scheduling
+    seed, start, end, image_size = batch
+
+    images = np.zeros((end - start, *image_size, 3), dtype=np.uint8)
+    masks = np.zeros((end - start, *image_size), dtype=np.uint8)
+    for i in range(start, end):
+        images[i - start], masks[i - start] = render_image(image_size, rng=random.Random('{}/{}'.format(seed, i)))
+
+    return start, images, masks
+
+
+def build_shapes_store(path, num_samples, image_size, seed=42, batch_size=256, workers=os.cpu_count()):
+    os.makedirs(path, exist_ok=True)
+
+    images = np.lib.format.open_memmap(
+        os.path.join(path, 'images.npy'), mode='w+', dtype=np.uint8, shape=(num_samples, *image_size, 3))
+    masks = np.lib.format.open_memmap(
+        os.path.join(path, 'masks.npy'), mode='w+', dtype=np.uint8, shape=(num_samples, *image_size))
+
+    batches = [(seed, start, min(start + batch_size, num_samples), tuple(image_size))
+               for start in range(0, num_samples, batch_size)]
+    with Pool(workers) as pool:
+        for start, batch_images, batch_masks in tqdm(pool.imap_unordered(render_batch, batches), total=len(batches)):
+            images[start:start + len(batch_images)] = batch_images
+            masks[start:start + len(batch_masks)] = batch_masks
+
+    images.flush()
+    masks.flush()
+    np.save(os.path.join(path, 'meta.npy'), np.array([seed, num_samples, *image_size]))
+
+
 def compute_iou(box, boxes, box_area, boxes_area):
     """Calculates IoU of the given box with the array of the given boxes.
     box: 1D vector [y1, x1, y2, x2]
@@ -61,41 +132,91 @@ def compute_iou(box, boxes, box_area, boxes_area):
     return iou
 
 
-def non_max_suppression(boxes, scores, threshold):
+def compute_iou_matrix(boxes_a, boxes_b):
+    """Calculates IoU of every box in boxes_a with every box in boxes_b.
+    boxes_a: [N, (y1, x1, y2, x2)]
+    boxes_b: [M, (y1, x1, y2, x2)]
+    Returns [N, M] IoU matrix.
+    """
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+
+    y1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    x1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+    union = area_a[:, None] + area_b[None, :] - intersection
+    iou = intersection / union
+    return iou
+
+
+def non_max_suppression(boxes, scores, threshold, block_size=1024):
     """Performs non-maximum supression and returns indicies of kept boxes.
     boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
     scores: 1-D array of box scores.
     threshold: Float. IoU threshold to use for filtering.
+    block_size: IoU is computed for this many boxes at a time against the rest,
+                so memory is bounded by [block_size, N].
     """
     assert boxes.shape[0] > 0
     if boxes.dtype.kind != "f":
         boxes = boxes.astype(np.float32)
 
-    # Compute box areas
-    y1 = boxes[:, 0]
-    x1 = boxes[:, 1]
-    y2 = boxes[:, 2]
-    x2 = boxes[:, 3]
-    area = (y2 - y1) * (x2 - x1)
-
     # Get indicies of boxes sorted by scores (highest first)
     ixs = scores.argsort()[::-1]
+    boxes = boxes[ixs]
 
-    pick = []
-    while len(ixs) > 0:
-        # Pick top box and add its index to the list
-        i = ixs[0]
-        pick.append(i)
-        # Compute IoU of the picked box with the rest
-        iou = compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
-        # Identify boxes with IoU over the threshold. This
-        # returns indicies into ixs[1:], so add 1 to get
-        # indicies into ixs.
-        remove_ixs = np.where(iou > threshold)[0] + 1
-        # Remove indicies of the picked and overlapped boxes.
-        ixs = np.delete(ixs, remove_ixs)
-        ixs = np.delete(ixs, 0)
-    return np.array(pick, dtype=np.int32)
+    keep = np.ones(len(ixs), dtype=np.bool_)
+    for start in range(0, len(ixs), block_size):
+        end = min(start + block_size, len(ixs))
+        iou = compute_iou_matrix(boxes[start:end], boxes[start:])
+        for i in range(start, end):
+            if keep[i]:
+                # Suppress lower scored boxes with IoU over the threshold
+                keep[i + 1:] &= ~(iou[i - start, i - start + 1:] > threshold)
+    return ixs[keep].astype(np.int32)
+
+
+def batched_non_max_suppression(boxes, scores, classes, threshold, block_size=1024):
+    """Performs non-maximum supression independently for every class and returns indicies of kept boxes
+    sorted by score. Boxes of different classes are moved apart, so that they never overlap,
+    and suppressed in a single pass.
+    classes: 1-D array of integer box classes.
+    """
+    assert boxes.shape[0] > 0
+    if boxes.dtype.kind != "f":
+        boxes = boxes.astype(np.float32)
+
+    offset = boxes.max() - boxes.min() + 1
+    boxes = boxes - boxes.min() + (classes * offset)[:, None]
+    return non_max_suppression(boxes, scores, threshold, block_size=block_size)
+
+
+def non_max_suppression_torch(boxes, scores, threshold):
+    """Same as non_max_suppression for torch tensors, stays on the device of the boxes.
+    boxes: [N, (y1, x1, y2, x2)]
+    scores: [N]
+    """
+    boxes = boxes.float()
+    ixs = scores.argsort(descending=True)
+    boxes = boxes[ixs]
+
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    y1 = torch.max(boxes[:, None, 0], boxes[None, :, 0])
+    y2 = torch.min(boxes[:, None, 2], boxes[None, :, 2])
+    x1 = torch.max(boxes[:, None, 1], boxes[None, :, 1])
+    x2 = torch.min(boxes[:, None, 3], boxes[None, :, 3])
+    intersection = (x2 - x1).clamp(min=0) * (y2 - y1).clamp(min=0)
+    iou = intersection / (area[:, None] + area[None, :] - intersection)
+
+    # only higher scored boxes can suppress lower scored ones
+    suppress = torch.triu(iou > threshold, 1)
+    keep = torch.ones(len(ixs), dtype=torch.bool, device=boxes.device)
+    for i in range(len(ixs)):
+        # masked by keep[i] on the device, so there is no sync per box
+        keep = keep & ~(suppress[i] & keep[i])
+    return ixs[keep]
 
 
 def draw_shape(image, shape, dims, color):
@@ -118,7 +239,7 @@ def draw_shape(image, shape, dims, color):
     return image
 
 
-def random_shape(image_size):
+def random_shape(image_size, rng=random):
     """Generates specifications of a random shape that lies within
     the given height and width boundaries.
     Returns a tuple of three valus:
@@ -128,32 +249,32 @@ def random_shape(image_size):
                         and location. Differs per shape type.
     """
     # Shape
-    shape = random.choice(["square", "circle", "triangle"])
+    shape = rng.choice(["square", "circle", "triangle"])
     # Color
-    color = tuple([random.randint(0, 255) for _ in range(3)])
+    color = tuple([rng.randint(0, 255) for _ in range(3)])
     # Center x, y
     buffer = 20
-    y = random.randint(buffer, image_size[0] - buffer - 1)
-    x = random.randint(buffer, image_size[1] - buffer - 1)
+    y = rng.randint(buffer, image_size[0] - buffer - 1)
+    x = rng.randint(buffer, image_size[1] - buffer - 1)
     # Size
-    s = random.randint(buffer, image_size[0] // 4)
+    s = rng.randint(buffer, image_size[0] // 4)
     return shape, color, (x, y, s)
 
 
-def random_image(image_size):
+def random_image(image_size, rng=random):
     """Creates random specifications of an image with multiple shapes.
     Returns the background color of the image and a list of shape
     specifications that can be used to draw the image.
     """
     # Pick random background color
-    bg_color = np.array([random.randint(0, 255) for _ in range(3)])
+    bg_color = np.array([rng.randint(0, 255) for _ in range(3)])
     # Generate a few random shapes and record their
     # bounding boxes
     shapes = []
     boxes = []
-    N = random.randint(1, 4)
+    N = rng.randint(1, 4)
     for _ in range(N):
-        shape, color, dims = random_shape(image_size)
+        shape, color, dims = random_shape(image_size, rng=rng)
         shapes.append((shape, color, dims))
         x, y, s = dims
         boxes.append([y - s, x - s, y + s, x + s])
@@ -162,3 +283,17 @@ def random_image(image_size):
     keep_ixs = non_max_suppression(np.array(boxes), np.arange(N), 0.3)
     shapes = [s for i, s in enumerate(shapes) if i in keep_ixs]
     return bg_color, shapes
+
+
+@click.command()
+@click.option('--path', type=click.Path(), required=True)
+@click.option('--num-samples', type=click.INT, default=32000)
+@click.option('--image-size', type=click.INT, default=256)
+@click.option('--seed', type=click.INT, default=42)
+@click.option('--workers', type=click.INT, default=os.cpu_count())
+def main(path, num_samples, image_size, seed, workers):
+    build_shapes_store(path, num_samples, (image_size, image_size), seed=seed, workers=workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import os
+from multiprocessing import Pool
+
+import click
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from stal.dataset import IMAGE_SIZE, build_data, decode_mask, load_pl_mask
+from stal.transforms import compute_crop_cdf
+
+
+@click.command()
+@click.option('--dataset-path', type=click.Path(), required=True)
+@click.option('--pl-path', type=click.Path(), default='./pl')
+@click.option('--cache-path', type=click.Path(), default='./stal/cache')
+@click.option('--workers', type=click.INT, default=os.cpu_count())
+def main(dataset_path, pl_path, cache_path, workers):
+    train_data = pd.read_csv(os.path.join(dataset_path, 'train.csv'), converters={'EncodedPixels': str})
+    train_data['root'] = os.path.join(dataset_path, 'train_images')
+    train_data = build_data(train_data)
+
+    samples = [(id, rles, None) for id, rles in zip(train_data['id'], train_data['rles'])]
+
+    if os.path.exists(pl_path):
+        test_data = pd.read_csv(
+            os.path.join(dataset_path, 'sample_submission.csv'), converters={'EncodedPixels': str})
+        test_data['root'] = os.path.join(dataset_path, 'test_images')
+        test_data = build_data(test_data)
+
+        for id in test_data['id']:
+            path = os.path.join(pl_path, '{}.npy'.format(id))
+            if os.path.exists(path):
+                samples.append((id, None, path))
+
+    os.makedirs(cache_path, exist_ok=True)
+    masks = np.lib.format.open_memmap(
+        os.path.join(cache_path, 'masks.npy'), mode='w+', dtype=np.uint8, shape=(len(samples), *IMAGE_SIZE))
+    crop_cdfs = np.lib.format.open_memmap(
+        os.path.join(cache_path, 'crop_cdfs.npy'), mode='w+', dtype=np.int64, shape=(len(samples), IMAGE_SIZE[1] + 1))
+
+    with Pool(workers) as pool:
+        for i, (mask, crop_cdf) in enumerate(
+                tqdm(pool.imap(build_mask, samples, chunksize=16), total=len(samples))):
+            masks[i] = mask
+            crop_cdfs[i] = crop_cdf
+
+    masks.flush()
+    crop_cdfs.flush()
+    np.save(os.path.join(cache_path, 'ids.npy'), np.array([id for id, _, _ in samples]))
+
+
+def build_mask(sample):
+    _, rles, pl_path = sample
+
+    if rles is None:
+        mask = load_pl_mask(pl_path)
+    else:
+        mask = decode_mask(rles)
+
+    return mask, compute_crop_cdf(mask)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,7 @@ def main():
         train_eval_data = pd.read_csv(os.path.join(dataset_path, 'train.csv'), converters={'EncodedPixels': str})
         train_eval_data['root'] = os.path.join(dataset_path, 'train_images')
         train_eval_data = build_data(train_eval_data)
-        train_eval_dataset = TrainEvalDataset(train_eval_data)
+        train_eval_dataset = TrainEvalDataset(train_eval_data, compact=True)
 
         all_areas = []
         for input in tqdm(train_eval_dataset):
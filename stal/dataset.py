@@ -7,15 +7,19 @@ import torch
 from PIL import Image
 from tqdm import tqdm
 
+from memmap import LazyMemmap
 from stal.utils import rle_decode
 
 NUM_CLASSES = 5
+IMAGE_SIZE = (256, 1600)
 
 
 class TrainEvalDataset(torch.utils.data.Dataset):
-    def __init__(self, data, transform=None):
+    def __init__(self, data, transform=None, compact=False, masks=None):
         self.data = data
         self.transform = transform
+        self.compact = compact
+        self.masks = masks
 
     def __len__(self):
         return len(self.data)
@@ -27,27 +31,28 @@ class TrainEvalDataset(torch.utils.data.Dataset):
         image = np.array(image)
         image = (image / 255).astype(np.float32)
 
-        if sample['rles'] is None:
-            mask = np.load('./pl/{}.npy'.format(sample['id']))
-            mask = np.argmax(mask, -1)
-            mask = np.eye(NUM_CLASSES, dtype=np.float32)[mask]
+        crop_cdf = None
+        if self.masks is not None:
+            mask = np.array(self.masks[sample['id']])
+            crop_cdf = np.array(self.masks.crop_cdf(sample['id']))
+        elif sample['rles'] is None:
+            mask = load_pl_mask('./pl/{}.npy'.format(sample['id']))
         else:
-            mask = np.zeros(image.shape[:2], dtype=np.int32)
-            for i, rle in enumerate(sample['rles'], 1):
-                m = rle_decode(rle, image.shape[:2])
-                assert m.dtype == np.bool
-                assert np.all(mask[m] == 0)
-                mask[m] = i
+            mask = decode_mask(sample['rles'], image.shape[:2])
+
+        # compact masks stay class-index maps and are one-hot encoded on device
+        if not self.compact:
             mask = np.eye(NUM_CLASSES, dtype=np.float32)[mask]
 
-        assert np.allclose(mask.sum(2), np.ones(mask.shape[:2]))
-        assert image.shape[:2] == mask.shape[:2] == (256, 1600)
+        assert image.shape[:2] == mask.shape[:2] == IMAGE_SIZE
 
         input = {
             'image': image,
             'mask': mask,
             'id': sample['id'],
         }
+        if crop_cdf is not None:
+            input['crop_cdf'] = crop_cdf
 
         if self.transform is not None:
             input = self.transform(input)
@@ -55,6 +60,20 @@ class TrainEvalDataset(torch.utils.data.Dataset):
         return input
 
 
+class MaskCache(object):
+    def __init__(self, path):
+        self.path = path
+        self.index = {id: i for i, id in enumerate(np.load(os.path.join(path, 'ids.npy')))}
+        self.masks = LazyMemmap(os.path.join(path, 'masks.npy'))
+        self.crop_cdfs = LazyMemmap(os.path.join(path, 'crop_cdfs.npy'))
+
+    def __getitem__(self, id):
+        return self.masks[self.index[id]]
+
+    def crop_cdf(self, id):
+        return self.crop_cdfs[self.index[id]]
+
+
 class TestDataset(torch.utils.data.Dataset):
     def __init__(self, data, transform=None):
         self.data = data
@@ -99,3 +118,21 @@ def build_data(data):
     data = pd.DataFrame(data)
 
     return data
+
+
+def decode_mask(rles, size=IMAGE_SIZE):
+    mask = np.zeros(size, dtype=np.uint8)
+    for i, rle in enumerate(rles, 1):
+        m = rle_decode(rle, size)
+        assert m.dtype == np.bool
+        assert np.all(mask[m] == 0)
+        mask[m] = i
+
+    return mask
+
+
+def load_pl_mask(path):
+    mask = np.load(path)
+    mask = np.argmax(mask, -1).astype(np.uint8)
+
+    return mask
@@ -2,6 +2,7 @@ import gc
 import os
 import random
 
+import click
 import numpy as np
 import pandas as pd
 import torch
@@ -16,12 +17,17 @@ from tqdm import tqdm
 
 from config import Config
 from stal.dataset import NUM_CLASSES, TestDataset, build_data
-from stal.model_cls import Model, Ensemble
-from stal.utils import rle_encode
+from stal.model_cls import Model
+from stal.utils import rle_encode_batch, predict_tiled
 from transforms import ApplyTo, Extract
 
 FOLDS = list(range(1, 5 + 1))
 DEVICE = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+TTA_FLIPS = {
+    'none': ((),),
+    'h': ((), (3,)),
+    'hv': ((), (3,), (2,), (2, 3)),
+}
 
 normalize = T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
 
@@ -31,7 +37,6 @@ test_transform = T.Compose([
         T.Compose([
             T.ToTensor(),
             normalize,
-            T.Lambda(lambda x: torch.stack([x], 0))
         ])),
     Extract(['image', 'id']),
 ])
@@ -67,10 +72,11 @@ def seed_torch(seed):
     torch.backends.cudnn.benchmark = False
 
 
-def build_submission(folds, test_data, temp, experiment_path, config, workers):
+def build_submission(folds, test_data, temp, experiment_path, config, workers, tile_width, tile_overlap, flips):
     with torch.no_grad():
         rles, ids = predict_on_test_using_fold(
-            folds, test_data, experiment_path=experiment_path, config=config, workers=workers)
+            folds, test_data, experiment_path=experiment_path, config=config, workers=workers,
+            tile_width=tile_width, tile_overlap=tile_overlap, flips=flips)
 
         submission_rles = []
         submission_ids = []
@@ -83,7 +89,7 @@ def build_submission(folds, test_data, temp, experiment_path, config, workers):
         submission.to_csv('./submission.csv', index=False)
 
 
-def predict_on_test_using_fold(folds, test_data, experiment_path, config, workers):
+def predict_on_test_using_fold(folds, test_data, experiment_path, config, workers, tile_width, tile_overlap, flips):
     test_dataset = TestDataset(test_data, transform=test_transform)
     test_data_loader = torch.utils.data.DataLoader(
         test_dataset,
@@ -96,11 +102,10 @@ def predict_on_test_using_fold(folds, test_data, experiment_path, config, worker
         model = Model(config.model, NUM_CLASSES, pretrained=False)
         model = model.to(DEVICE)
         model.load_state_dict(torch.load(os.path.join(experiment_path, 'model_{}.pth'.format(fold))))
+        model.eval()
         models.append(model)
-    model = Ensemble(models)
     del fold
 
-    model.eval()
     with torch.no_grad():
         fold_rles = []
         fold_ids = []
@@ -108,18 +113,9 @@ def predict_on_test_using_fold(folds, test_data, experiment_path, config, worker
         for images, ids in tqdm(test_data_loader, desc='inference'):
             images = images.to(DEVICE)
 
-            b, nt, c, h, w = images.size()
-            images = images.view(b * nt, c, h, w)
-            class_logits, mask_logits = model(images)
-            _, nm, _ = class_logits.size()
-            class_logits = class_logits.view(b, nt * nm, NUM_CLASSES)
-            mask_logits = mask_logits.view(b, nt * nm, NUM_CLASSES, h, w)
-
-            n_dim = 1
-            c_dim = 2
-
-            class_probs = class_logits.sigmoid().mean(n_dim)
-            mask_probs = mask_logits.softmax(c_dim).mean(n_dim)
+            b, _, h, w = images.size()
+            class_probs, mask_probs = predict_tiled(
+                models, images, tile_width=tile_width, overlap=tile_overlap, flips=flips)
 
             class_probs = class_probs[:, 1:]
             mask_probs = one_hot(mask_probs.argmax(1))[:, 1:]
@@ -127,10 +123,8 @@ def predict_on_test_using_fold(folds, test_data, experiment_path, config, worker
             class_probs = (class_probs > 0.5).float().view(class_probs.size(0), class_probs.size(1), 1, 1)
             mask_probs = mask_probs * class_probs
 
-            rles = [
-                [rle_encode(c) for c in mask]
-                for mask in mask_probs.data.cpu().numpy()
-            ]
+            rles = rle_encode_batch(mask_probs.reshape(b * (NUM_CLASSES - 1), h, w))
+            rles = [rles[i:i + NUM_CLASSES - 1] for i in range(0, len(rles), NUM_CLASSES - 1)]
 
             fold_rles.extend(rles)
             fold_ids.extend(ids)
@@ -138,7 +132,18 @@ def predict_on_test_using_fold(folds, test_data, experiment_path, config, worker
     return fold_rles, fold_ids
 
 
-def main(folds, experiment_path, dataset_path, workers):
+@click.command()
+@click.option('--experiment-path', type=click.Path(), required=True)
+@click.option('--dataset-path', type=click.Path(), required=True)
+@click.option('--folds', type=click.INT, multiple=True, default=FOLDS)
+@click.option('--workers', type=click.INT, default=os.cpu_count())
+@click.option('--tile-width', type=click.IntRange(min=1), default=1600)
+@click.option('--tile-overlap', type=click.IntRange(min=0), default=0)
+@click.option('--tta', type=click.Choice(list(TTA_FLIPS)), default='none')
+def main(experiment_path, dataset_path, folds, workers, tile_width, tile_overlap, tta):
+    if tile_overlap >= tile_width:
+        raise click.BadParameter('must be less than --tile-width', param_hint='--tile-overlap')
+
     config = Config.from_json(os.path.join(experiment_path, 'config.yaml'))
 
     seed_python(config.seed)
@@ -156,7 +161,9 @@ def main(folds, experiment_path, dataset_path, workers):
     temp = None
     gc.collect()
 
-    build_submission(folds, test_data, temp, experiment_path=experiment_path, config=config, workers=workers)
+    build_submission(
+        folds, test_data, temp, experiment_path=experiment_path, config=config, workers=workers,
+        tile_width=tile_width, tile_overlap=tile_overlap, flips=TTA_FLIPS[tta])
 
 
 if __name__ == '__main__':
@@ -21,14 +21,15 @@ import lr_scheduler_wrapper
 import optim
 import utils
 from config import Config
-from losses import dice_loss
-from losses import sigmoid_cross_entropy
+from losses import label_dice_loss
+from losses import label_sigmoid_cross_entropy
 from lr_scheduler import OneCycleScheduler
 from radam import RAdam
 from stal.dataset import NUM_CLASSES, TrainEvalDataset, TestDataset
 from stal.model import Model
-from stal.transforms import ApplyTo, Extract
+from stal.transforms import MaskToTensor
 from stal.utils import mask_to_image
+from transforms import ApplyTo, Extract
 
 # torch.backends.cudnn.benchmark = True
 
@@ -90,21 +91,27 @@ class RandomResize(object):
 train_transform = T.Compose([
     # RandomCrop((256, 1024)),
     ApplyTo(
-        ['image', 'mask'],
+        ['image'],
         T.ToTensor()),
     ApplyTo(
         ['mask'],
-        T.Lambda(lambda x: x.long())),
+        T.Compose([
+            MaskToTensor(),
+            T.Lambda(lambda x: x.long()),
+        ])),
     Extract(['image', 'mask', 'id']),
 ])
 eval_transform = T.Compose([
     # CenterCrop((256, 1024)),
     ApplyTo(
-        ['image', 'mask'],
+        ['image'],
         T.ToTensor()),
     ApplyTo(
         ['mask'],
-        T.Lambda(lambda x: x.long())),
+        T.Compose([
+            MaskToTensor(),
+            T.Lambda(lambda x: x.long()),
+        ])),
     Extract(['image', 'mask', 'id']),
 ])
 test_transform = T.Compose([
@@ -198,14 +205,12 @@ def one_hot(input):
 #
 #     return loss
 
-def compute_loss(input, target, axis=(2, 3)):
-    target = one_hot(target.squeeze(1))
-
-    input, target = input[:, 1:], target[:, 1:]
+def compute_loss(input, target):
+    target = target.long()
 
-    ce = sigmoid_cross_entropy(input=input, target=target).mean(axis).mean(1)
+    ce = label_sigmoid_cross_entropy(input=input, target=target)[:, 1:].mean(1)
     # focal = softmax_focal_loss(input=input, target=target, axis=1, keepdim=True).mean(axis).mean(1)
-    dice = dice_loss(input=input.sigmoid(), target=target, axis=axis).mean(1)
+    dice = label_dice_loss(input=input.sigmoid(), target=target)[:, 1:].mean(1)
 
     loss = [
         ce,
@@ -220,7 +225,7 @@ def compute_loss(input, target, axis=(2, 3)):
 
 def compute_metric(input, target, axis=(2, 3)):
     input = one_hot(input.argmax(1))
-    target = one_hot(target.squeeze(1))
+    target = one_hot(target)
     input, target = input[:, 1:], target[:, 1:]
 
     intersection = (input * target).sum(axis)
@@ -305,7 +310,7 @@ def indices_for_fold(fold, dataset):
 
 
 def lr_search(train_eval_data):
-    train_eval_dataset = TrainEvalDataset(train_eval_data, transform=train_transform)
+    train_eval_dataset = TrainEvalDataset(train_eval_data, transform=train_transform, compact=True)
     train_eval_data_loader = torch.utils.data.DataLoader(
         train_eval_dataset,
         batch_size=config.batch_size,
@@ -424,8 +429,8 @@ def train_epoch(model, optimizer, scheduler, data_loader, fold, epoch):
         writer.add_scalar('learning_rate', lr, global_step=epoch)
 
         images = images[:32]
-        masks = mask_to_image(masks[:32], num_classes=NUM_CLASSES)
-        preds = mask_to_image(logits[:32].argmax(1, keepdim=True), num_classes=NUM_CLASSES)
+        masks = mask_to_image(one_hot(masks[:32]), num_classes=NUM_CLASSES)
+        preds = mask_to_image(one_hot(logits[:32].argmax(1)), num_classes=NUM_CLASSES)
 
         writer.add_image('images', torchvision.utils.make_grid(
             images, nrow=compute_nrow(images), normalize=True), global_step=epoch)
@@ -469,8 +474,8 @@ def eval_epoch(model, data_loader, fold, epoch):
             writer.add_scalar(k, metrics[k], global_step=epoch)
 
         images = images[:32]
-        masks = mask_to_image(masks[:32], num_classes=NUM_CLASSES)
-        preds = mask_to_image(logits[:32].argmax(1, keepdim=True), num_classes=NUM_CLASSES)
+        masks = mask_to_image(one_hot(masks[:32]), num_classes=NUM_CLASSES)
+        preds = mask_to_image(one_hot(logits[:32].argmax(1)), num_classes=NUM_CLASSES)
 
         writer.add_image('images', torchvision.utils.make_grid(
             images, nrow=compute_nrow(images), normalize=True), global_step=epoch)
@@ -485,7 +490,7 @@ def eval_epoch(model, data_loader, fold, epoch):
 def train_fold(fold, train_eval_data):
     train_indices, eval_indices = indices_for_fold(fold, train_eval_data)  # FIXME: dataset size
 
-    train_dataset = TrainEvalDataset(train_eval_data.iloc[train_indices], transform=train_transform)
+    train_dataset = TrainEvalDataset(train_eval_data.iloc[train_indices], transform=train_transform, compact=True)
     train_data_loader = torch.utils.data.DataLoader(
         train_dataset,
         batch_size=config.batch_size,
@@ -493,7 +498,7 @@ def train_fold(fold, train_eval_data):
         shuffle=True,
         num_workers=args.workers,
         worker_init_fn=worker_init_fn)
-    eval_dataset = TrainEvalDataset(train_eval_data.iloc[eval_indices], transform=eval_transform)
+    eval_dataset = TrainEvalDataset(train_eval_data.iloc[eval_indices], transform=eval_transform, compact=True)
     eval_data_loader = torch.utils.data.DataLoader(
         eval_dataset,
         batch_size=config.batch_size,
@@ -648,7 +653,7 @@ def predict_on_test_using_fold(fold, test_data):
 def predict_on_eval_using_fold(fold, train_eval_data):
     _, eval_indices = indices_for_fold(fold, train_eval_data)
     eval_data = train_eval_data.iloc[eval_indices]
-    eval_dataset = TrainEvalDataset(eval_data, transform=eval_transform)
+    eval_dataset = TrainEvalDataset(eval_data, transform=eval_transform, compact=True)
     eval_data_loader = torch.utils.data.DataLoader(
         eval_dataset,
         batch_size=config.batch_size,
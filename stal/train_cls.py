@@ -26,10 +26,10 @@ from losses import softmax_cross_entropy, softmax_focal_loss, sigmoid_focal_loss
 from lr_scheduler import OneCycleScheduler
 from radam import RAdam
 from stal.compute_image_stats import compute_buckets
-from stal.dataset import NUM_CLASSES, TrainEvalDataset, TestDataset, build_data
+from stal.dataset import NUM_CLASSES, TrainEvalDataset, TestDataset, MaskCache, build_data
 from stal.model_cls import Model, Ensemble
-from stal.transforms import RandomHorizontalFlip, RandomVerticalFlip, SampledRandomCrop, RandomCrop
-from stal.utils import mask_to_image, rle_encode
+from stal.transforms import RandomHorizontalFlip, RandomVerticalFlip, SampledRandomCrop, RandomCrop, MaskToTensor
+from stal.utils import mask_to_image, rle_encode_batch
 from transforms import ApplyTo, Extract, Resettable, RandomGamma, RandomBrightness, RandomContrast
 
 FOLDS = list(range(1, 5 + 1))
@@ -40,6 +40,7 @@ parser.add_argument('--config-path', type=str, required=True)
 parser.add_argument('--experiment-path', type=str, default='./tf_log/stal')
 parser.add_argument('--dataset-path', type=str, required=True)
 parser.add_argument('--restore-path', type=str)
+parser.add_argument('--mask-cache-path', type=str)
 parser.add_argument('--workers', type=int, default=os.cpu_count())
 parser.add_argument('--fold', type=int, choices=FOLDS)
 parser.add_argument('--infer', action='store_true')
@@ -48,6 +49,11 @@ args = parser.parse_args()
 config = Config.from_json(args.config_path)
 shutil.copy(args.config_path, os.path.join(utils.mkdir(args.experiment_path), 'config.yaml'))
 
+if args.mask_cache_path is not None:
+    mask_cache = MaskCache(args.mask_cache_path)
+else:
+    mask_cache = None
+
 normalize = T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
 
 if config.aug.crop.type == 'random':
@@ -73,7 +79,7 @@ train_transform = T.Compose([
     ApplyTo(
         ['mask'],
         T.Compose([
-            T.ToTensor(),
+            MaskToTensor(),
         ])),
     Extract(['image', 'mask', 'id']),
 ])
@@ -87,7 +93,7 @@ eval_transform = T.Compose([
     ApplyTo(
         ['mask'],
         T.Compose([
-            T.ToTensor(),
+            MaskToTensor(),
         ])),
     Extract(['image', 'mask', 'id']),
 ])
@@ -142,7 +148,16 @@ def one_hot(input):
     return utils.one_hot(input, num_classes=NUM_CLASSES).permute((0, 3, 1, 2))
 
 
+def expand_mask(input):
+    if input.dim() == 3:
+        input = one_hot(input.long())
+
+    return input
+
+
 def compute_loss(class_input, mask_input, target):
+    target = expand_mask(target)
+
     class_loss = compute_class_loss(input=class_input, target=target)
     mask_loss = compute_mask_loss(input=mask_input, target=target)
 
@@ -195,6 +210,8 @@ def compute_mask_loss(input, target, axis=(2, 3)):
 # TODO: check correctness
 # TODO: use argmax after masking
 def compute_metric(class_input, mask_input, target, axis=(2, 3)):
+    target = expand_mask(target)
+
     class_pred = (class_input[:, 1:] > 0.).float()
     del class_input
 
@@ -305,7 +322,8 @@ def indices_for_fold(fold, data):
 
 
 def lr_search(train_eval_data):
-    train_eval_dataset = TrainEvalDataset(train_eval_data, transform=train_transform)
+    train_eval_dataset = TrainEvalDataset(
+        train_eval_data, transform=train_transform, compact=config.compact_mask, masks=mask_cache)
     train_eval_data_loader = torch.utils.data.DataLoader(
         train_eval_dataset,
         batch_size=config.batch_size,
@@ -426,7 +444,7 @@ def train_epoch(model, optimizer, scheduler, data_loader, fold, epoch):
         writer.add_scalar('learning_rate', lr, global_step=epoch)
 
         images = images[:32]
-        masks = mask_to_image(masks[:32], num_classes=NUM_CLASSES)
+        masks = mask_to_image(expand_mask(masks[:32]), num_classes=NUM_CLASSES)
         preds = mask_to_image(one_hot(mask_logits[:32].argmax(1)), num_classes=NUM_CLASSES)
         probs = mask_to_image(mask_logits[:32].softmax(1), num_classes=NUM_CLASSES)
 
@@ -483,7 +501,7 @@ def eval_epoch(model, data_loader, fold, epoch):
             writer.add_scalar(k, metrics[k], global_step=epoch)
 
         images = images[:32]
-        masks = mask_to_image(masks[:32], num_classes=NUM_CLASSES)
+        masks = mask_to_image(expand_mask(masks[:32]), num_classes=NUM_CLASSES)
         preds = mask_to_image(one_hot(mask_logits[:32].argmax(1)), num_classes=NUM_CLASSES)
         probs = mask_to_image(mask_logits[:32].softmax(1), num_classes=NUM_CLASSES)
 
@@ -510,7 +528,8 @@ def train_fold(fold, train_eval_data, tmp):
     #     tmp,
     # ])
 
-    train_dataset = TrainEvalDataset(train_data, transform=train_transform)
+    train_dataset = TrainEvalDataset(
+        train_data, transform=train_transform, compact=config.compact_mask, masks=mask_cache)
     # weights = weights[train_indices]
     # assert len(train_dataset) == len(weights)
     train_data_loader = torch.utils.data.DataLoader(
@@ -521,7 +540,8 @@ def train_fold(fold, train_eval_data, tmp):
         shuffle=True,
         num_workers=args.workers,
         worker_init_fn=worker_init_fn)
-    eval_dataset = TrainEvalDataset(eval_data, transform=eval_transform)
+    eval_dataset = TrainEvalDataset(
+        eval_data, transform=eval_transform, compact=config.compact_mask, masks=mask_cache)
     eval_data_loader = torch.utils.data.DataLoader(
         eval_dataset,
         batch_size=config.batch_size,
@@ -720,10 +740,8 @@ def predict_on_test_using_fold(folds, test_data):
             class_probs = (class_probs > 0.5).float().view(class_probs.size(0), class_probs.size(1), 1, 1)
             mask_probs = mask_probs * class_probs
 
-            rles = [
-                [rle_encode(c) for c in mask]
-                for mask in mask_probs.data.cpu().numpy()
-            ]
+            rles = rle_encode_batch(mask_probs.reshape(b * (NUM_CLASSES - 1), h, w))
+            rles = [rles[i:i + NUM_CLASSES - 1] for i in range(0, len(rles), NUM_CLASSES - 1)]
 
             fold_rles.extend(rles)
             fold_ids.extend(ids)
@@ -734,7 +752,8 @@ def predict_on_test_using_fold(folds, test_data):
 def predict_on_eval_using_fold(fold, train_eval_data):
     _, eval_indices = indices_for_fold(fold, train_eval_data)
     eval_data = train_eval_data.iloc[eval_indices]
-    eval_dataset = TrainEvalDataset(eval_data, transform=eval_transform)
+    eval_dataset = TrainEvalDataset(
+        eval_data, transform=eval_transform, compact=config.compact_mask, masks=mask_cache)
     eval_data_loader = torch.utils.data.DataLoader(
         eval_dataset,
         batch_size=config.batch_size,
@@ -3,6 +3,7 @@ import random
 
 import cv2
 import numpy as np
+import torch
 import torchvision.transforms.functional as F
 
 
@@ -98,30 +99,38 @@ class SampledRandomCrop(object):
         self.padding_mode = padding_mode
 
     @staticmethod
-    def get_params(image, mask, output_size):
+    def get_params(image, mask, output_size, crop_cdf=None):
         h, w, _ = image.shape
         th, tw = output_size
         if w == tw and h == th:
             return 0, 0, h, w
 
-        m = mask[:, :, 1:].sum((0, 2))
-        m = m + 1
-        m = np.convolve(m, np.ones(tw), mode='valid')
-        m = m / m.sum()
+        if crop_cdf is None:
+            crop_cdf = compute_crop_cdf(mask)
+
+        # cumulative weight of window origins 0..j, where each window weights columns by occupancy + 1
+        n = w - tw + 1
+        cdf = crop_cdf[tw:tw + n] - crop_cdf[tw - 1] - crop_cdf[:n]
 
         i = random.randint(0, h - th)
-        j = np.random.choice(np.arange(0, w - tw + 1), p=m)
+        j = np.searchsorted(cdf, np.random.uniform(0, cdf[-1]), side='right')
+        j = min(j, n - 1)
 
         return i, j, th, tw
 
     def __call__(self, input):
+        if self.padding is None and not self.pad_if_needed:
+            crop_cdf = input.get('crop_cdf')
+        else:
+            crop_cdf = None
+
         input = {
             **input,
             'image': self.preprocess(input['image']),
             'mask': self.preprocess(input['mask']),
         }
 
-        i, j, h, w = self.get_params(input['image'], input['mask'], self.size)
+        i, j, h, w = self.get_params(input['image'], input['mask'], self.size, crop_cdf=crop_cdf)
 
         return crop(input, i, j, h, w)
 
@@ -139,6 +148,14 @@ class SampledRandomCrop(object):
         return image
 
 
+class MaskToTensor(object):
+    def __call__(self, input):
+        if input.ndim == 2:
+            return torch.from_numpy(np.ascontiguousarray(input))
+
+        return F.to_tensor(input)
+
+
 class CenterCrop(object):
     def __init__(self, size):
         if isinstance(size, numbers.Number):
@@ -181,6 +198,20 @@ def transpose(input):
     }
 
 
+def compute_crop_cdf(mask):
+    if mask.ndim == 2:
+        m = (mask > 0).sum(0)
+    else:
+        m = mask[:, :, 1:].sum((0, 2))
+    m = m + 1
+
+    # prefix sums of prefix sums, so window sums and their cdf are O(1) lookups for any crop width
+    m = np.concatenate([[0], np.cumsum(m)])
+    m = np.cumsum(m)
+
+    return m
+
+
 # TODO: check
 def crop(input, i, j, h, w):
     return {
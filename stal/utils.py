@@ -1,30 +1,43 @@
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 
 def rle_encode(image):
-    dots = np.where(image.T.flatten() == 1)[0]
-    run_lengths = []
-    prev = -2
+    pixels = np.concatenate([[0], image.T.flatten() == 1, [0]])
+    runs = np.where(pixels[1:] != pixels[:-1])[0] + 1
+    runs[1::2] -= runs[::2]
 
-    for b in dots:
-        if b > prev + 1:
-            run_lengths.extend((b + 1, 0))
+    return runs.tolist()
 
-        run_lengths[-1] += 1
-        prev = b
 
-    return run_lengths
+def rle_encode_batch(images):
+    b, h, w = images.size()
+
+    pixels = (images.transpose(1, 2).reshape(b, h * w) == 1).to(torch.int8)
+    pixels = F.pad(pixels, (1, 1))
+    batch, runs = torch.nonzero(pixels[:, 1:] != pixels[:, :-1], as_tuple=True)
+
+    # every image contributes an even number of edges, so consecutive pairs never cross images
+    runs = (runs + 1).view(-1, 2)
+    runs[:, 1] -= runs[:, 0]
+    counts = torch.bincount(batch[::2], minlength=b) * 2
+
+    runs = runs.view(-1).data.cpu().numpy()
+    counts = counts.data.cpu().numpy()
+
+    return [r.tolist() for r in np.split(runs, np.cumsum(counts)[:-1])]
 
 
 def rle_decode(rle, size):
-    starts, lengths = [np.asarray(x) for x in (rle[0:][::2], rle[1:][::2])]
+    starts, lengths = [np.asarray(x, dtype=np.int64) for x in (rle[0:][::2], rle[1:][::2])]
     starts -= 1
     ends = starts + lengths
-    image = np.zeros(size[0] * size[1], dtype=np.bool)
 
-    for lo, hi in zip(starts, ends):
-        image[lo:hi] = 1
+    delta = np.zeros(size[0] * size[1] + 1, dtype=np.int32)
+    np.add.at(delta, starts, 1)
+    np.add.at(delta, ends, -1)
+    image = np.cumsum(delta[:-1]) > 0
 
     return image.reshape((size[1], size[0])).T
 
@@ -41,3 +54,67 @@ def mask_to_image(mask, num_classes):
     image = image.sum(1)
 
     return image
+
+
+def tile_starts(size, tile_size, overlap):
+    if tile_size >= size:
+        return [0]
+    assert 0 <= overlap < tile_size
+
+    starts = list(range(0, size - tile_size, tile_size - overlap))
+    starts.append(size - tile_size)
+
+    return starts
+
+
+def tile_weights(tile_size, overlap):
+    x = np.arange(tile_size)
+    weights = np.minimum(np.minimum(x + 1, tile_size - x) / (overlap + 1), 1.)
+
+    return weights
+
+
+def predict_tiled(models, images, tile_width, overlap=0, flips=((),)):
+    assert 0 <= overlap < tile_width
+
+    b, _, h, w = images.size()
+    tile_width = min(tile_width, w)
+    weights = torch.tensor(tile_weights(tile_width, overlap), dtype=images.dtype, device=images.device)
+
+    class_probs = None
+    mask_probs = None
+    mask_weights = torch.zeros(w, dtype=images.dtype, device=images.device)
+
+    for j in tile_starts(w, tile_width, overlap):
+        tile = images[:, :, :, j:j + tile_width]
+        tile_class_probs = 0.
+        tile_mask_probs = 0.
+
+        # folds and tta are accumulated into a single buffer instead of being stacked
+        for dims in flips:
+            input = tile.flip(dims) if len(dims) > 0 else tile
+
+            for model in models:
+                class_logits, mask_logits = model(input)
+                if len(dims) > 0:
+                    mask_logits = mask_logits.flip(dims)
+
+                tile_class_probs = tile_class_probs + class_logits.sigmoid()
+                tile_mask_probs = tile_mask_probs + mask_logits.softmax(1)
+
+        n = len(flips) * len(models)
+        tile_class_probs = tile_class_probs / n
+        tile_mask_probs = tile_mask_probs / n
+
+        if mask_probs is None:
+            class_probs = tile_class_probs
+            mask_probs = torch.zeros(b, tile_mask_probs.size(1), h, w, dtype=images.dtype, device=images.device)
+        else:
+            class_probs = torch.max(class_probs, tile_class_probs)
+
+        mask_probs[:, :, :, j:j + tile_width] += tile_mask_probs * weights
+        mask_weights[j:j + tile_width] += weights
+
+    mask_probs = mask_probs / mask_weights
+
+    return class_probs, mask_probs
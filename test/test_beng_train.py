@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import sklearn.metrics
+import torch
+
+import utils  # noqa: F401, utils and beng.train import each other, utils has to be imported first
+from beng.dataset import CLASS_META, split_target
+from beng.train import HMAR, TargetStore, compute_loss
+from config2 import Config as C
+
+
+def reference_compute_loss(input, target, config):
+    def compute(input, target, dim=-1):
+        if config.label_smoothing is not None:
+            target = target * (1 - config.label_smoothing) + config.label_smoothing / target.size(dim)
+
+        ce = -(target * input.log_softmax(dim)).sum(dim)
+
+        prob = input.softmax(dim)
+        tp = (target * prob).sum()
+        fn = (target * (1 - prob)).sum()
+        r = 1 - tp / (tp + fn + 1e-7)
+
+        return 0.5 * ce.mean() + 0.5 * r
+
+    input = split_target(input)
+    target = split_target(target)
+    loss = [compute(input=i, target=t) for i, t in zip(input, target)]
+
+    return sum([l * w for l, w in zip(loss, CLASS_META['weight'].values)])
+
+
+def test_compute_loss():
+    torch.manual_seed(42)
+    input = torch.randn(8, CLASS_META['num_classes'].sum())
+    target = torch.cat([
+        torch.eye(num_classes)[torch.randint(0, num_classes, (8,))]
+        for num_classes in CLASS_META['num_classes']], 1)
+
+    for label_smoothing in [None, 0.1]:
+        config = C(label_smoothing=label_smoothing)
+        loss, terms = compute_loss(input=input, target=target, config=config)
+
+        assert torch.allclose(loss, reference_compute_loss(input, target, config), atol=1e-5)
+        assert torch.allclose(terms['entropy'], torch.stack([
+            -(i.softmax(-1) * i.log_softmax(-1)).sum(-1) for i in split_target(input)], -1), atol=1e-5)
+
+
+def test_hmar():
+    rng = np.random.RandomState(42)
+    # few samples, so that some classes are missing from targets, predictions or both
+    input = np.stack([rng.randint(0, n, 64) for n in CLASS_META['num_classes']], 1)
+    target = np.stack([rng.randint(0, n, 64) for n in CLASS_META['num_classes']], 1)
+    target[:32] = input[:32]
+
+    metric = HMAR()
+    for i in range(0, 64, 16):
+        metric.update(input=torch.tensor(input[i:i + 16]), target=torch.tensor(target[i:i + 16]))
+
+    scores = [
+        sklearn.metrics.recall_score(target[..., i], input[..., i], average='macro')
+        for i in range(input.shape[-1])
+    ]
+    expected = np.average(scores, weights=CLASS_META['weight'].values)
+
+    assert np.isclose(metric.compute(), expected)
+
+
+def test_target_store(tmpdir):
+    rng = np.random.RandomState(42)
+    data = pd.DataFrame({
+        component: rng.randint(0, num_classes, 10)
+        for component, num_classes in zip(CLASS_META['component'], CLASS_META['num_classes'])})
+    indices = torch.tensor([7, 2, 5])
+    probs = torch.cat([torch.rand(3, num_classes).softmax(1) for num_classes in CLASS_META['num_classes']], 1)
+
+    for topk in [None, 3]:
+        store = TargetStore(data, topk=topk, device='cpu')
+        initial = store[torch.arange(10)]
+        assert torch.equal(torch.stack([t.argmax(1) for t in split_target(initial)], 1), torch.tensor(data.values))
+        assert torch.allclose(torch.stack([t.sum(1) for t in split_target(initial)], 1), torch.ones(10, 3))
+
+        store[indices] = probs
+        if topk is None:
+            expected = probs
+        else:
+            expected = []
+            for p in split_target(probs):
+                values, i = p.topk(topk, 1)
+                expected.append(torch.zeros_like(p).scatter_(1, i, values / values.sum(1, keepdim=True)))
+            expected = torch.cat(expected, 1)
+        assert torch.allclose(store[indices], expected, atol=1e-3)
+
+        torch.save(store.state_dict(), str(tmpdir.join('store.pth')))
+        restored = TargetStore(data.iloc[:0], topk=topk, device='cpu')
+        restored.load_state_dict(torch.load(str(tmpdir.join('store.pth'))))
+
+        assert len(restored) == len(store)
+        assert torch.equal(restored[torch.arange(10)], store[torch.arange(10)])
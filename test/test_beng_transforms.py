@@ -0,0 +1,34 @@
+import torch
+
+from beng.transforms import BatchRandomAffineCrop, BatchCenterCrop
+
+
+def test_batch_random_affine_crop():
+    input = torch.rand(4, 1, 20, 30)
+
+    torch.manual_seed(42)
+    actual = BatchRandomAffineCrop((10, 16), degrees=0, scale=(1., 1.))(input)
+
+    torch.manual_seed(42)
+    torch.empty(4).uniform_(0, 0)
+    torch.empty(4).uniform_(1., 1.)
+    i = torch.randint(0, 20 - 10 + 1, (4,))
+    j = torch.randint(0, 30 - 16 + 1, (4,))
+    expected = torch.stack([x[:, t:t + 10, l:l + 16] for x, t, l in zip(input, i, j)], 0)
+
+    assert torch.allclose(actual, expected, atol=1e-5)
+
+
+def test_batch_random_affine_crop_preserves_center():
+    input = torch.zeros(8, 1, 21, 31)
+    input[:, :, 10, 15] = 1.
+
+    output = BatchRandomAffineCrop((21, 31), degrees=15, scale=(0.8, 1 / 0.8))(input)
+
+    assert torch.allclose(output[:, :, 10, 15], torch.ones(8, 1), atol=1e-5)
+
+
+def test_batch_center_crop():
+    input = torch.rand(4, 1, 20, 30)
+
+    assert torch.equal(BatchCenterCrop((10, 16))(input), input[:, :, 5:15, 7:23])
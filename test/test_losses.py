@@ -0,0 +1,40 @@
+import torch
+
+from losses import dice_loss, iou_loss, label_dice_loss, label_iou_loss, label_sigmoid_cross_entropy, \
+    sigmoid_cross_entropy
+from lovasz_losses import lovasz_hinge_batched, lovasz_hinge_flat, lovasz_softmax, lovasz_softmax_batched
+
+
+def test_label_losses():
+    input = torch.randn(3, 5, 8, 9)
+    target = torch.randint(0, 5, (3, 8, 9))
+    one_hot = torch.eye(5)[target].permute(0, 3, 1, 2)
+
+    assert torch.allclose(
+        label_iou_loss(input.softmax(1), target), iou_loss(input.softmax(1), one_hot, axis=(2, 3)), atol=1e-6)
+    assert torch.allclose(
+        label_dice_loss(input.sigmoid(), target), dice_loss(input.sigmoid(), one_hot, axis=(2, 3)), atol=1e-6)
+    assert torch.allclose(
+        label_sigmoid_cross_entropy(input, target), sigmoid_cross_entropy(input, one_hot).mean((2, 3)), atol=1e-6)
+
+
+def test_lovasz_softmax_batched():
+    probas = torch.randn(3, 5, 7, 6).softmax(1)
+    labels = torch.randint(0, 4, (3, 7, 6))
+    labels[0, :2] = 255
+
+    for per_image in [False, True]:
+        for classes in ['present', 'all', [1, 3]]:
+            expected = lovasz_softmax(probas, labels, classes=classes, per_image=per_image, ignore=255)
+            actual = lovasz_softmax_batched(probas, labels, classes=classes, per_image=per_image, ignore=255)
+
+            assert torch.allclose(actual, expected, atol=1e-5)
+
+
+def test_lovasz_hinge_batched():
+    logits = torch.randn(4, 30)
+    labels = (torch.rand(4, 30) > 0.7).float()
+
+    expected = torch.stack([lovasz_hinge_flat(l, t) for l, t in zip(logits, labels)])
+
+    assert torch.allclose(lovasz_hinge_batched(logits, labels), expected, atol=1e-6)
@@ -0,0 +1,15 @@
+import pickle
+
+import numpy as np
+
+from memmap import LazyMemmap
+
+
+def test_lazy_memmap(tmpdir):
+    path = str(tmpdir.join('a.npy'))
+    np.save(path, np.arange(10))
+    array = LazyMemmap(path)
+
+    assert len(array) == 10
+    assert np.array_equal(array[2:4], [2, 3])
+    assert pickle.loads(pickle.dumps(array)).array is None
@@ -0,0 +1,30 @@
+import numpy as np
+
+from mol.dataset import PackedGraphs, save_packed_graphs
+
+
+def test_packed_graphs_collate(tmpdir):
+    rng = np.random.RandomState(42)
+    graphs = []
+    for _ in range(5):
+        n, e = rng.randint(2, 6), rng.randint(1, 8)
+        graphs.append({
+            'x': rng.rand(n, 8),
+            'edge_index': rng.randint(0, n, (e, 2)),
+            'edge_attr': rng.rand(e, 5),
+            'y': rng.rand(e, 5),
+            'u': rng.rand(1, 14),
+        })
+    save_packed_graphs(str(tmpdir), ['mol_{}'.format(i) for i in range(5)], graphs)
+
+    indices = [3, 0, 4]
+    batch = PackedGraphs(str(tmpdir)).collate(indices)
+
+    num_nodes = [len(graphs[i]['x']) for i in indices]
+    shift = np.cumsum(num_nodes) - num_nodes
+    edge_index = np.concatenate([graphs[i]['edge_index'] + s for i, s in zip(indices, shift)], 0).T
+
+    assert np.array_equal(batch.edge_index.numpy(), edge_index)
+    assert np.array_equal(batch.batch.numpy(), np.repeat(np.arange(3), num_nodes))
+    for k in ['x', 'edge_attr', 'y', 'u']:
+        assert np.allclose(batch[k].numpy(), np.concatenate([graphs[i][k] for i in indices], 0))
@@ -0,0 +1,122 @@
+import warnings
+
+import ase
+import ase.data
+import numpy as np
+import pandas as pd
+
+from mol.prepare_data import build_graphs, group_edges, segment_mean_std
+
+
+def reference_graph_to_data(nodes, edges, symbol_to_index, bond_to_index):
+    x = np.zeros((len(nodes), 8))
+    for node in nodes:
+        x[node.index, 0] = symbol_to_index[node.symbol]
+        x[node.index, 1:4] = [node.x, node.y, node.z]
+        features = [
+            ase.data.atomic_masses,
+            ase.data.covalent_radii,
+            ase.data.ground_state_magnetic_moments,
+            ase.data.vdw_radii
+        ]
+        x[node.index, 4:] = [f[node.number] for f in features]
+
+    i = edges['atom_index_0'].values
+    j = edges['atom_index_1'].values
+
+    edge_attr = np.zeros((len(edges), 5))
+    edge_attr[:, 0] = [bond_to_index[b] for b in edges['type'].values]
+    dist = np.linalg.norm(nodes.positions[i] - nodes.positions[j], axis=-1)
+    edge_attr[:, 1] = dist
+    edge_attr[:, 2:] = np.abs(nodes.positions[i] - nodes.positions[j])
+
+    # molecules without edges give nan stats, which the old code replaced with 0
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        u = [*nodes.positions.mean(0), *nodes.positions.std(0)]
+        u = [*u, dist.mean(), dist.std()]
+        dist = np.abs(nodes.positions[i] - nodes.positions[j])
+        u = [*u, *dist.mean(0), *dist.std(0)]
+    u = np.array([u])
+    u[u != u] = 0.
+
+    return {
+        'x': x,
+        'edge_index': np.array([i, j]),
+        'edge_attr': edge_attr,
+        'y': edges[['scalar_coupling_constant', 'fc', 'sd', 'pso', 'dso']].values,
+        'u': u,
+    }
+
+
+def build_molecules(rng):
+    mol_names = ['mol_{}'.format(k) for k in range(4)]
+    molecules = [
+        ase.Atoms(rng.choice(['C', 'H', 'N', 'O'], n).tolist(), positions=rng.randn(n, 3))
+        for n in [5, 2, 3, 7]]
+
+    edges = []
+    for name, mol, num_edges in zip(mol_names, molecules, [6, 1, 0, 9]):
+        for _ in range(num_edges):
+            i, j = rng.choice(len(mol), 2, replace=False)
+            edges.append({
+                'molecule_name': name, 'atom_index_0': i, 'atom_index_1': j,
+                'type': rng.choice(['1JHC', '2JHH', '3JHN']),
+                **{k: rng.randn() for k in ['scalar_coupling_constant', 'fc', 'sd', 'pso', 'dso']}})
+    edges.append({**edges[0], 'molecule_name': 'mol_unknown'})
+    edges = pd.DataFrame(edges).sample(frac=1, random_state=42).reset_index(drop=True)
+
+    return mol_names, molecules, edges
+
+
+def test_group_edges():
+    mol_names, _, edges = build_molecules(np.random.RandomState(42))
+    grouped, num_edges = group_edges(edges, mol_names)
+
+    expected = [edges[edges['molecule_name'] == name] for name in mol_names]
+    assert num_edges.tolist() == [len(e) for e in expected]
+    assert grouped.equals(pd.concat(expected).reset_index(drop=True))
+
+
+def test_build_graphs():
+    rng = np.random.RandomState(42)
+    mol_names, molecules, edges = build_molecules(rng)
+    edges, num_edges = group_edges(edges, mol_names)
+    bond_order = rng.randint(0, 3, len(edges))
+
+    symbols = sorted({s for mol in molecules for s in mol.get_chemical_symbols()})
+    symbol_to_index = {s: i for i, s in enumerate(symbols)}
+    bond_to_index = {b: i for i, b in enumerate(sorted(edges['type'].unique()))}
+
+    num_nodes = np.array([len(mol) for mol in molecules])
+    numbers = np.concatenate([mol.numbers for mol in molecules])
+    positions = np.concatenate([mol.positions for mol in molecules], 0)
+    graphs = build_graphs(
+        numbers, positions, num_nodes, edges, num_edges, bond_order, symbol_to_index, bond_to_index)
+
+    node_offsets = np.concatenate([[0], np.cumsum(num_nodes)])
+    edge_offsets = np.concatenate([[0], np.cumsum(num_edges)])
+    for k, mol in enumerate(molecules):
+        nodes, es = slice(node_offsets[k], node_offsets[k + 1]), slice(edge_offsets[k], edge_offsets[k + 1])
+        expected = reference_graph_to_data(mol, edges.iloc[es], symbol_to_index, bond_to_index)
+
+        assert np.allclose(graphs['x'][nodes], expected['x'])
+        assert np.array_equal(graphs['edge_index'][es].T, expected['edge_index'])
+        assert np.allclose(graphs['edge_attr'][es, :5], expected['edge_attr'])
+        assert np.array_equal(graphs['edge_attr'][es, 5], bond_order[es])
+        assert np.allclose(graphs['y'][es], expected['y'])
+        assert np.allclose(graphs['u'][k:k + 1], expected['u'])
+
+
+def test_segment_mean_std():
+    values = np.random.RandomState(42).randn(10, 3)
+    segments = np.array([0, 0, 0, 2, 2, 2, 2, 3, 3, 3])
+    mean, std = segment_mean_std(values, segments, 5)
+
+    for k in range(5):
+        expected = values[segments == k]
+        if len(expected) == 0:
+            assert np.all(mean[k] == 0) and np.all(std[k] == 0)
+        else:
+            assert np.allclose(mean[k], expected.mean(0))
+            assert np.allclose(std[k], expected.std(0))
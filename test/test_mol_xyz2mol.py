@@ -0,0 +1,99 @@
+import itertools
+
+import numpy as np
+from rdkit import Chem
+
+from mol.xyz2mol import canonical_smiles, get_UA_pairs, xyz2AC, xyz2mol
+
+
+def reference_xyz2AC(atomicNumList, xyz):
+    mol = Chem.MolFromSmarts('[#{}]'.format(atomicNumList[0]))
+    mol = Chem.RWMol(mol)
+    for atom in atomicNumList[1:]:
+        mol.AddAtom(Chem.Atom(atom))
+    mol = mol.GetMol()
+    conf = Chem.Conformer(mol.GetNumAtoms())
+    for i in range(mol.GetNumAtoms()):
+        conf.SetAtomPosition(i, (xyz[i][0], xyz[i][1], xyz[i][2]))
+    mol.AddConformer(conf)
+
+    dMat = Chem.Get3DDistanceMatrix(mol)
+    pt = Chem.GetPeriodicTable()
+
+    num_atoms = len(atomicNumList)
+    AC = np.zeros((num_atoms, num_atoms)).astype(int)
+    for i in range(num_atoms):
+        Rcov_i = pt.GetRcovalent(atomicNumList[i]) * 1.30
+        for j in range(i + 1, num_atoms):
+            Rcov_j = pt.GetRcovalent(atomicNumList[j]) * 1.30
+            if dMat[i, j] <= Rcov_i + Rcov_j:
+                AC[i, j] = 1
+                AC[j, i] = 1
+
+    return AC
+
+
+def reference_get_UA_pairs(UA, AC):
+    bonds = []
+    for k, i in enumerate(UA):
+        for j in UA[k + 1:]:
+            if AC[i, j] == 1:
+                bonds.append(tuple(sorted([i, j])))
+    if len(bonds) == 0:
+        return [()]
+
+    max_atoms_in_combo = 0
+    UA_pairs = [()]
+    for combo in list(itertools.combinations(bonds, int(len(UA) / 2))):
+        flat_list = [item for sublist in combo for item in sublist]
+        atoms_in_combo = len(set(flat_list))
+        if atoms_in_combo > max_atoms_in_combo:
+            max_atoms_in_combo = atoms_in_combo
+            UA_pairs = [combo]
+        elif atoms_in_combo == max_atoms_in_combo:
+            UA_pairs.append(combo)
+
+    return UA_pairs
+
+
+def test_xyz2AC():
+    rng = np.random.RandomState(42)
+
+    for _ in range(10):
+        n = rng.randint(2, 20)
+        atomicNumList = rng.choice([1, 6, 7, 8, 9], n).tolist()
+        xyz = rng.uniform(0, 4, (n, 3)).tolist()
+        AC, mol = xyz2AC(atomicNumList, xyz)
+
+        assert np.array_equal(AC, reference_xyz2AC(atomicNumList, xyz))
+        assert mol.GetNumAtoms() == n
+
+
+def test_get_UA_pairs():
+    rng = np.random.RandomState(42)
+
+    for _ in range(50):
+        n = rng.randint(2, 12)
+        AC = np.triu(rng.rand(n, n) < 0.4, 1).astype(int)
+        AC = AC + AC.T
+        UA = sorted(rng.choice(n, rng.randint(0, n + 1), replace=False).tolist())
+
+        assert get_UA_pairs(UA, AC, quick=False) == reference_get_UA_pairs(UA, AC)
+        assert get_UA_pairs(UA, AC, quick=False, cache={}) == reference_get_UA_pairs(UA, AC)
+
+
+def test_xyz2mol():
+    # ethanol and acetaldehyde, the latter needs a double bond from the bond order search
+    for atomicNumList, xyz, expected in [
+        ([6, 6, 8, 1, 1, 1, 1, 1, 1], [
+            [-0.0476, -0.4431, 0.0000], [1.4587, -0.1990, 0.0000], [-0.6933, 0.8137, 0.0000],
+            [-0.3453, -1.0075, 0.8862], [-0.3453, -1.0075, -0.8862], [1.7564, 0.3654, 0.8862],
+            [1.7564, 0.3654, -0.8862], [1.9997, -1.1433, 0.0000], [-1.6516, 0.6388, 0.0000]], 'CCO'),
+        ([6, 6, 8, 1, 1, 1, 1], [
+            [-0.0350, 0.4520, 0.0000], [1.4510, 0.1210, 0.0000], [-0.9090, -0.3990, 0.0000],
+            [-0.2860, 1.5310, 0.0000], [1.6540, -0.9500, 0.0000], [1.9150, 0.5610, 0.8880],
+            [1.9150, 0.5610, -0.8880]], 'CC=O'),
+    ]:
+        mol = xyz2mol(atomicNumList, 0, xyz, charged_fragments=True, quick=False)
+
+        assert canonical_smiles(mol) == expected
@@ -0,0 +1,57 @@
+import torch
+
+import utils  # noqa: F401, utils and beng.train import each other, utils has to be imported first
+from segmentation.train import NUM_CLASSES, compute_confusion, compute_dataset_metric, compute_metric, one_hot
+
+
+def reference_compute_metric(input, target):
+    def dice(input, target):
+        axis = (2, 3)
+
+        intersection = (input * target).sum(axis)
+        union = input.sum(axis) + target.sum(axis)
+        v = (2. * intersection) / union
+        v[v != v] = 0.
+        v = v.mean(1)
+
+        return v
+
+    def iou(input, target):
+        axis = (2, 3)
+
+        intersection = (input * target).sum(axis)
+        union = input.sum(axis) + target.sum(axis) - intersection
+        v = intersection / union
+        v[v != v] = 0.
+        v = v.mean(1)
+
+        return v
+
+    return {
+        'dice': dice(input=one_hot(input.argmax(1, keepdim=True), NUM_CLASSES), target=one_hot(target, NUM_CLASSES)),
+        'iou': iou(input=one_hot(input.argmax(1, keepdim=True), NUM_CLASSES), target=one_hot(target, NUM_CLASSES)),
+    }
+
+
+def test_compute_metric():
+    torch.manual_seed(42)
+    # few classes per image, so that most classes are missing from both target and prediction
+    target = torch.randint(0, 4, (3, 1, 8, 10))
+    input = torch.randn(3, NUM_CLASSES, 8, 10)
+    input[:, :4] += 4 * one_hot(target, NUM_CLASSES)[:, :4]
+
+    confusion = compute_confusion(input=input, target=target)
+    actual = compute_metric(confusion)
+    expected = reference_compute_metric(input=input, target=target)
+
+    for k in expected:
+        assert torch.allclose(actual[k], expected[k], atol=1e-6)
+
+    input, target = one_hot(input.argmax(1, keepdim=True), NUM_CLASSES), one_hot(target, NUM_CLASSES)
+    intersection = (input * target).sum((0, 2, 3))
+    union = input.sum((0, 2, 3)) + target.sum((0, 2, 3))
+    present = union > 0
+    dataset_metric = compute_dataset_metric(confusion.sum(0))
+
+    assert abs(dataset_metric['dataset_dice'] - (2 * intersection / union)[present].mean().item()) < 1e-6
+    assert abs(dataset_metric['dataset_iou'] - (intersection / (union - intersection))[present].mean().item()) < 1e-6
@@ -0,0 +1,62 @@
+import numpy as np
+import torch
+
+from shapes import ShapesStore, batched_non_max_suppression, build_shapes_store, compute_iou, non_max_suppression, \
+    non_max_suppression_torch
+
+
+def non_max_suppression_reference(boxes, scores, threshold):
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    ixs = scores.argsort()[::-1]
+
+    pick = []
+    while len(ixs) > 0:
+        i = ixs[0]
+        pick.append(i)
+        iou = compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
+        ixs = np.delete(ixs, np.where(iou > threshold)[0] + 1)
+        ixs = np.delete(ixs, 0)
+    return np.array(pick, dtype=np.int32)
+
+
+def random_boxes(rng, n):
+    yx = rng.uniform(0, 100, (n, 2))
+    hw = rng.uniform(5, 30, (n, 2))
+    return np.concatenate([yx, yx + hw], 1).astype(np.float32)
+
+
+def test_non_max_suppression():
+    rng = np.random.RandomState(42)
+    boxes = random_boxes(rng, 200)
+    scores = rng.uniform(size=200)
+    expected = non_max_suppression_reference(boxes, scores, 0.3)
+
+    assert np.array_equal(non_max_suppression(boxes, scores, 0.3, block_size=32), expected)
+    assert np.array_equal(
+        non_max_suppression_torch(torch.tensor(boxes), torch.tensor(scores), 0.3).numpy(), expected)
+
+
+def test_batched_non_max_suppression():
+    rng = np.random.RandomState(42)
+    boxes = random_boxes(rng, 200)
+    scores = rng.uniform(size=200)
+    classes = rng.randint(0, 3, 200)
+
+    expected = np.concatenate([
+        np.where(classes == c)[0][non_max_suppression_reference(boxes[classes == c], scores[classes == c], 0.3)]
+        for c in range(3)])
+    expected = expected[scores[expected].argsort()[::-1]]
+
+    assert np.array_equal(batched_non_max_suppression(boxes, scores, classes, 0.3), expected)
+
+
+def test_build_shapes_store(tmpdir):
+    build_shapes_store(str(tmpdir.join('a')), 10, (96, 96), seed=1, batch_size=3, workers=2)
+    build_shapes_store(str(tmpdir.join('b')), 10, (96, 96), seed=1, batch_size=10, workers=1)
+
+    a, b = ShapesStore(str(tmpdir.join('a'))), ShapesStore(str(tmpdir.join('b')))
+    assert len(a) == 10
+    for (image_a, mask_a), (image_b, mask_b) in zip(a, b):
+        assert np.array_equal(np.array(image_a), np.array(image_b))
+        assert np.array_equal(np.array(mask_a), np.array(mask_b))
+        assert np.array(mask_a).max() < 4
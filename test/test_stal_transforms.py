@@ -0,0 +1,46 @@
+import numpy as np
+
+from stal.transforms import SampledRandomCrop, compute_crop_cdf
+
+
+def reference_window_probs(mask, tw):
+    if mask.ndim == 2:
+        m = (mask > 0).sum(0)
+    else:
+        m = mask[:, :, 1:].sum((0, 2))
+    m = m + 1
+    m = np.convolve(m, np.ones(tw), mode='valid')
+    m = m / m.sum()
+
+    return m
+
+
+def test_compute_crop_cdf():
+    mask = np.random.RandomState(42).randint(0, 5, (16, 100))
+    mask[:, 20:60] = 0
+
+    for mask in [mask, np.eye(5)[mask]]:
+        crop_cdf = compute_crop_cdf(mask)
+
+        for tw in [1, 7, 32, 99, 100]:
+            n = mask.shape[1] - tw + 1
+            cdf = crop_cdf[tw:tw + n] - crop_cdf[tw - 1] - crop_cdf[:n]
+            probs = np.diff(cdf, prepend=0) / cdf[-1]
+
+            assert np.allclose(probs, reference_window_probs(mask, tw))
+
+
+def test_sampled_random_crop_get_params(monkeypatch):
+    mask = np.random.RandomState(42).randint(0, 5, (16, 100))
+    mask[:, 20:60] = 0
+    image = np.zeros((*mask.shape, 3))
+    quantiles = np.random.RandomState(42).uniform(0, 1, 100)
+
+    for tw in [7, 32, 99]:
+        expected = np.searchsorted(np.cumsum(reference_window_probs(mask, tw)), quantiles, side='right')
+
+        for q, j in zip(quantiles, expected):
+            monkeypatch.setattr(np.random, 'uniform', lambda low, high: low + q * (high - low))
+            _, actual, _, _ = SampledRandomCrop.get_params(image, mask, (16, tw))
+
+            assert actual == j
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+import torch
+
+from stal.utils import rle_encode, rle_encode_batch, rle_decode, predict_tiled, tile_starts
+
+
+def reference_rle_encode(image):
+    dots = np.where(image.T.flatten() == 1)[0]
+    run_lengths = []
+    prev = -2
+
+    for b in dots:
+        if b > prev + 1:
+            run_lengths.extend((b + 1, 0))
+
+        run_lengths[-1] += 1
+        prev = b
+
+    return run_lengths
+
+
+def test_rle_encode():
+    images = np.random.RandomState(42).uniform(size=(8, 16, 24)) > 0.7
+    images[0] = False
+    images[1] = True
+    images[2, 0, 0] = images[2, -1, -1] = True
+
+    for image in images:
+        assert rle_encode(image) == reference_rle_encode(image)
+        assert rle_encode(image.astype(np.float32)) == reference_rle_encode(image)
+
+
+def test_rle_encode_batch():
+    images = np.random.RandomState(42).uniform(size=(8, 16, 24)) > 0.7
+    images[0] = False
+    images[1] = True
+
+    actual = rle_encode_batch(torch.tensor(images, dtype=torch.float))
+    expected = [reference_rle_encode(image) for image in images]
+
+    assert actual == expected
+
+
+def test_rle_decode():
+    images = np.random.RandomState(42).uniform(size=(8, 16, 24)) > 0.7
+    images[0] = False
+    images[1] = True
+
+    for image in images:
+        actual = rle_decode(rle_encode(image), image.shape)
+
+        assert actual.dtype == np.bool
+        assert np.array_equal(actual, image)
+
+
+def test_predict_tiled():
+    class Model(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+
+            self.conv = torch.nn.Conv2d(3, 5, 1)
+
+        def forward(self, input):
+            input = self.conv(input)
+
+            return input.mean((2, 3)), input
+
+    torch.manual_seed(42)
+    models = [Model(), Model()]
+    images = torch.rand(2, 3, 8, 100)
+
+    expected = sum(m(images)[1].softmax(1) for m in models) / len(models)
+
+    with torch.no_grad():
+        for tile_width, overlap in [(100, 0), (32, 0), (32, 8), (40, 16)]:
+            class_probs, mask_probs = predict_tiled(
+                models, images, tile_width=tile_width, overlap=overlap, flips=((), (3,)))
+
+            assert class_probs.size() == (2, 5)
+            assert torch.allclose(mask_probs, expected, atol=1e-6)
+
+
+def test_tile_starts():
+    for size in [1, 99, 100, 1600]:
+        for tile_size in [1, 7, 32, 100]:
+            for overlap in range(min(tile_size, 10)):
+                starts = tile_starts(size, tile_size, overlap)
+                covered = np.zeros(size, dtype=np.bool_)
+                for j in starts:
+                    covered[j:j + tile_size] = True
+
+                assert covered.all()
+                assert starts[-1] + min(tile_size, size) == size
+
+
+def test_tile_overlap_rejected():
+    for overlap in [-1, 32, 40]:
+        with pytest.raises(AssertionError):
+            tile_starts(100, 32, overlap)
+        with pytest.raises(AssertionError):
+            predict_tiled([], torch.rand(1, 3, 8, 100), tile_width=32, overlap=overlap)
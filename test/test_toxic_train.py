@@ -0,0 +1,57 @@
+import numpy as np
+import torch
+from pytorch_pretrained_bert import BertConfig, BertForSequenceClassification
+
+from toxic.train import FeatureDataset, TokenBudgetBatchSampler, build_feature_cache, collate_fn
+
+
+def test_collate_fn():
+    input_ids, segment_ids, input_mask, label_ids = collate_fn([
+        (np.array([1, 2, 3], dtype=np.int32), 0),
+        (np.array([4], dtype=np.int32), 1),
+    ])
+
+    assert torch.equal(input_ids, torch.tensor([[1, 2, 3], [4, 0, 0]]))
+    assert torch.equal(segment_ids, torch.zeros(2, 3, dtype=torch.long))
+    assert torch.equal(input_mask, torch.tensor([[1, 1, 1], [1, 0, 0]]))
+    assert torch.equal(label_ids, torch.tensor([0, 1]))
+
+
+def test_token_budget_batch_sampler():
+    lengths = np.random.RandomState(42).randint(1, 50, 1000)
+    batches = list(TokenBudgetBatchSampler(lengths, max_tokens=200, chunk_size=100))
+
+    assert sorted(i for batch in batches for i in batch) == list(range(1000))
+    assert all(len(batch) * lengths[batch].max() <= 200 for batch in batches)
+
+
+def test_token_budget_batch_sampler_len():
+    sampler = TokenBudgetBatchSampler(np.random.RandomState(42).randint(1, 50, 1000), max_tokens=200, chunk_size=10)
+
+    for _ in range(3):
+        assert len(sampler) == len(list(sampler))
+
+
+def test_feature_cache(tmpdir):
+    torch.manual_seed(42)
+    config = BertConfig(
+        vocab_size_or_config_json_file=50, hidden_size=16, num_hidden_layers=1, num_attention_heads=2,
+        intermediate_size=32)
+    model = BertForSequenceClassification(config, num_labels=2)
+    model.eval()
+
+    samples = [(np.random.randint(1, 50, np.random.randint(3, 10)), label) for label in [0, 1, 1, 0, 1]]
+    data_loader = torch.utils.data.DataLoader(samples, batch_size=2, collate_fn=collate_fn)
+
+    build_feature_cache(model.bert, data_loader, np.arange(10, 15), str(tmpdir))
+    dataset = FeatureDataset(str(tmpdir), [3, 1])
+
+    for i, (feature, label) in zip([3, 1], dataset):
+        input_ids, segment_ids, input_mask, _ = collate_fn([samples[i]])
+        with torch.no_grad():
+            expected = model(input_ids, segment_ids, input_mask)[0]
+            actual = model.classifier(model.dropout(feature))
+
+        assert torch.allclose(actual, expected, atol=1e-2)
+        assert label.item() == samples[i][1]
+    assert np.array_equal(np.load(str(tmpdir.join('rows.npy'))), np.arange(10, 15))
@@ -0,0 +1,56 @@
+import torch
+
+from triplet_loss import batch_all_triplet_loss, batch_hard_triplet_loss, batch_semi_hard_triplet_loss, \
+    get_valid_triplets_mask, pairwise_distances
+
+
+def test_pairwise_distances():
+    input = torch.randn(10, 4)
+
+    expected = torch.norm(input.unsqueeze(0) - input.unsqueeze(1), 2, 2)
+
+    assert torch.allclose(pairwise_distances(input), expected, atol=1e-5)
+
+
+def test_batch_all_triplet_loss():
+    input = torch.randn(10, 4)
+    target = torch.randint(0, 3, (10,))
+
+    distances = torch.norm(input.unsqueeze(0) - input.unsqueeze(1), 2, 2)
+    loss = distances.unsqueeze(2) - distances.unsqueeze(1) + 0.5
+    loss = (loss * get_valid_triplets_mask(target).float()).clamp(min=0)
+    expected = loss.sum() / ((loss > 0).float().sum() + 1e-16)
+
+    assert torch.allclose(batch_all_triplet_loss(input, target, margin=0.5, chunk_size=3), expected, atol=1e-5)
+
+
+def test_batch_semi_hard_triplet_loss():
+    input = torch.randn(10, 4)
+    target = torch.randint(0, 3, (10,))
+
+    distances = torch.norm(input.unsqueeze(0) - input.unsqueeze(1), 2, 2)
+    losses = []
+    for a in range(10):
+        negatives = distances[a][target != target[a]]
+        for p in range(10):
+            if p == a or target[p] != target[a] or len(negatives) == 0:
+                continue
+            semi_hard = negatives[negatives > distances[a, p]]
+            negative = semi_hard.min() if len(semi_hard) > 0 else negatives.max()
+            losses.append((distances[a, p] - negative + 0.5).clamp(min=0))
+    expected = torch.stack(losses).mean()
+
+    assert torch.allclose(batch_semi_hard_triplet_loss(input, target, margin=0.5), expected, atol=1e-5)
+
+
+def test_batch_hard_triplet_loss():
+    input = torch.randn(10, 4)
+    target = torch.tensor([0, 0, 0, 1, 1, 1, 2, 2, 2, 2])
+
+    distances = torch.norm(input.unsqueeze(0) - input.unsqueeze(1), 2, 2)
+    same = target.unsqueeze(0) == target.unsqueeze(1)
+    expected = (
+            distances.masked_fill(~same, 0).max(1)[0] -
+            distances.masked_fill(same, float('inf')).min(1)[0] + 0.5).clamp(min=0)
+
+    assert torch.allclose(batch_hard_triplet_loss(input, target, margin=0.5), expected, atol=1e-5)
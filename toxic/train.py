@@ -13,6 +13,8 @@ import torch.utils.data
 from pytorch_pretrained_bert import BertTokenizer, BertForSequenceClassification
 from pytorch_pretrained_bert.optimization import BertAdam
 
+from memmap import LazyMemmap
+
 
 # Input data files are available in the "../input/" directory.
 # For example, running this (by clicking run or pressing Shift+Enter) will list the files in the input directory
@@ -26,50 +28,150 @@ from pytorch_pretrained_bert.optimization import BertAdam
 # os.system('pip install --no-index --find-links="../input/pytorchpretrainedbert/" pytorch_pretrained_bert')
 # # OPTIONAL: if you want to have more information on what's happening, activate the logger as follows
 
+DEVICE = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
 
-class TrainEvalDataset(torch.utils.data.Dataset):
-    def __init__(self, data):
-        self.data = data
+class TokenDataset(torch.utils.data.Dataset):
+    def __init__(self, path, indices):
+        self.path = path
+        self.indices = indices
+        self.tokens = LazyMemmap(os.path.join(path, 'tokens.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.labels = np.load(os.path.join(path, 'labels.npy'))
 
     def __len__(self):
-        return len(self.data)
+        return len(self.indices)
 
     def __getitem__(self, item):
-        row = self.data.iloc[item]
+        i = self.indices[item]
+
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]], self.labels[i]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)[self.indices]
+
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    # batches hold at most max_tokens tokens after padding. samples are shuffled, split into chunks,
+    # sorted by length within a chunk and then batched, so batches hold samples of similar length.
+    # batches of the upcoming epoch are built ahead, so that len() matches what the next iter() yields
+    def __init__(self, lengths, max_tokens, chunk_size=1000, shuffle=True):
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.chunk_size = chunk_size
+        self.shuffle = shuffle
+        self.batches = self.build_batches()
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        batches, self.batches = self.batches, self.build_batches()
+
+        return iter(batches)
+
+    def build_batches(self):
+        if self.shuffle:
+            indices = np.random.permutation(len(self.lengths))
+        else:
+            indices = np.arange(len(self.lengths))
+
+        batches = []
+        for start in range(0, len(indices), self.chunk_size):
+            chunk = indices[start:start + self.chunk_size]
+            chunk = chunk[np.argsort(self.lengths[chunk], kind='stable')]
 
-        text = "[CLS] {} [SEP".format(row['comment_text'])
-        tokens = tokenizer.tokenize(text)
-        input_id = tokenizer.convert_tokens_to_ids(tokens)
-        input_id = torch.tensor(input_id)
+            batch = []
+            for i in chunk:
+                # sorted ascending, so the current sample sets the padded length
+                if len(batch) > 0 and (len(batch) + 1) * self.lengths[i] > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+                batch.append(i)
+            if len(batch) > 0:
+                batches.append(batch)
 
-        segment_id = [0] * len(input_id)
-        segment_id = torch.tensor(segment_id)
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
 
-        input_mask = [1] * len(input_id)
-        input_mask = torch.tensor(input_mask)
+        return batches
 
-        label_id = row['target']
-        label_id = (label_id > 0.5).astype(np.int64)
-        label_id = torch.tensor(label_id)
 
-        return input_id, segment_id, input_mask, label_id
+def build_token_store(data, tokenizer, path, max_len=512):
+    # tokens of all samples are stored flat with offsets
+    os.makedirs(path, exist_ok=True)
 
+    tokens = []
+    for text in tqdm(data['comment_text'], desc='tokenizing'):
+        text = '[CLS] {} [SEP]'.format(text)
+        ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))
+        if len(ids) > max_len:
+            ids = ids[:max_len - 1] + ids[-1:]
+        tokens.append(np.array(ids, dtype=np.int32))
 
-def pad(tensors):
-    result = torch.zeros(len(tensors), max(t.size(0) for t in tensors), dtype=tensors[0].dtype)
+    np.save(os.path.join(path, 'tokens.npy'), np.concatenate(tokens))
+    np.save(os.path.join(path, 'offsets.npy'), np.concatenate([[0], np.cumsum([len(t) for t in tokens])]))
+    np.save(os.path.join(path, 'labels.npy'), (data['target'].values > 0.5).astype(np.int64))
+    np.save(os.path.join(path, 'rows.npy'), data.index.values)
 
-    for i, t in enumerate(tensors):
-        result[i, :t.size(0)] = tensors[i]
 
-    return result
+class FeatureDataset(torch.utils.data.Dataset):
+    def __init__(self, path, indices):
+        self.path = path
+        self.indices = indices
+        self.features = LazyMemmap(os.path.join(path, 'features.npy'))
+        self.labels = np.load(os.path.join(path, 'labels.npy'))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, item):
+        i = self.indices[item]
+
+        return torch.from_numpy(self.features[i].astype(np.float32)), torch.tensor(self.labels[i])
+
+
+def build_feature_cache(bert, data_loader, rows, path):
+    # pooled outputs of the frozen encoder are stored in data loader order
+    os.makedirs(path, exist_ok=True)
+
+    features = None
+    labels = []
+    offset = 0
+    bert.eval()
+    with torch.no_grad():
+        for input_ids, segment_ids, input_mask, label_ids in tqdm(data_loader, desc='building feature cache'):
+            _, pooled_output = bert(
+                input_ids.to(DEVICE), segment_ids.to(DEVICE), input_mask.to(DEVICE), output_all_encoded_layers=False)
+
+            if features is None:
+                features = np.lib.format.open_memmap(
+                    os.path.join(path, 'features.npy'),
+                    mode='w+',
+                    dtype=np.float16,
+                    shape=(len(rows), pooled_output.size(1)))
+
+            features[offset:offset + pooled_output.size(0)] = pooled_output.cpu().numpy()
+            labels.append(label_ids.numpy())
+            offset += pooled_output.size(0)
+
+    features.flush()
+    np.save(os.path.join(path, 'labels.npy'), np.concatenate(labels))
+    np.save(os.path.join(path, 'rows.npy'), np.asarray(rows))
 
 
 def collate_fn(batch):
-    input_ids, segment_ids, input_mask, label_ids = zip(*batch)
+    tokens, label_ids = zip(*batch)
+
+    lengths = np.array([len(t) for t in tokens])
+    input_mask = np.arange(lengths.max()) < lengths.reshape(-1, 1)
+    input_ids = np.zeros(input_mask.shape, dtype=np.int64)
+    input_ids[input_mask] = np.concatenate(tokens)
 
-    input_ids = pad(input_ids)
-    segment_ids = pad(segment_ids)
-    input_mask = pad(input_mask)
+    input_ids = torch.from_numpy(input_ids)
+    segment_ids = torch.zeros_like(input_ids)
+    input_mask = torch.from_numpy(input_mask.astype(np.int64))
     label_ids = torch.tensor(label_ids)
 
     return input_ids, segment_ids, input_mask, label_ids
@@ -81,6 +183,9 @@ if __name__ == '__main__':
 
     MODEL_PATH = 'bert-base-uncased'
     TOKENIZER_PATH = 'bert-base-uncased'
+    TOKEN_STORE_PATH = './data/toxic/tokens'
+    FEATURE_CACHE_PATH = './data/toxic/features'
+    USE_FEATURE_CACHE = True
 
     logging.basicConfig(level=logging.INFO)
 
@@ -112,6 +217,7 @@ if __name__ == '__main__':
         MODEL_PATH,
         cache_dir='./cache',
         num_labels=NUM_LABELS)
+    model = model.to(DEVICE)
     for m in model.bert.parameters():
         m.requires_grad = False
     # self.dropout = nn.Dropout(config.hidden_dropout_prob)
@@ -121,15 +227,40 @@ if __name__ == '__main__':
 
     EPOCHS = 10
     BATCH_SIZE = 4  # FIXME:
+    FEATURE_BATCH_SIZE = 1024
+    MAX_TOKENS = 4 * 256
     LR = 5e-5
     WARMUP = 0.1
 
     indices = np.random.permutation(len(train_eval_data))
     train_indices, eval_indices = indices[:-indices.shape[0] // 5], indices[-indices.shape[0] // 5:]
 
-    train_dataset = TrainEvalDataset(train_eval_data.iloc[train_indices])
-    train_data_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=BATCH_SIZE, shuffle=True, drop_last=True, collate_fn=collate_fn)
+    if not os.path.exists(os.path.join(TOKEN_STORE_PATH, 'rows.npy')):
+        build_token_store(train_eval_data, tokenizer, TOKEN_STORE_PATH)
+    assert np.array_equal(np.load(os.path.join(TOKEN_STORE_PATH, 'rows.npy')), train_eval_data.index.values)
+
+    if USE_FEATURE_CACHE:
+        # encoder is frozen, so its outputs are computed once and only the classifier is trained
+        if not os.path.exists(os.path.join(FEATURE_CACHE_PATH, 'rows.npy')):
+            build_feature_cache(
+                model.bert,
+                torch.utils.data.DataLoader(
+                    TokenDataset(TOKEN_STORE_PATH, np.arange(len(train_eval_data))),
+                    batch_size=BATCH_SIZE * 16,
+                    collate_fn=collate_fn),
+                train_eval_data.index.values,
+                FEATURE_CACHE_PATH)
+
+        assert np.array_equal(np.load(os.path.join(FEATURE_CACHE_PATH, 'rows.npy')), train_eval_data.index.values)
+        train_dataset = FeatureDataset(FEATURE_CACHE_PATH, train_indices)
+        train_data_loader = torch.utils.data.DataLoader(
+            train_dataset, batch_size=FEATURE_BATCH_SIZE, shuffle=True, drop_last=True)
+    else:
+        train_dataset = TokenDataset(TOKEN_STORE_PATH, train_indices)
+        train_data_loader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_sampler=TokenBudgetBatchSampler(train_dataset.lengths, MAX_TOKENS),
+            collate_fn=collate_fn)
 
     # param_optimizer = list(model.named_parameters())
     param_optimizer = list(model.classifier.named_parameters())
@@ -146,8 +277,13 @@ if __name__ == '__main__':
 
     for epoch in range(EPOCHS):
         model.train()
-        for input_ids, segment_ids, input_mask, label_ids in tqdm(train_data_loader):
-            logits = model(input_ids, segment_ids, input_mask, labels=None)
+        for batch in tqdm(train_data_loader):
+            if USE_FEATURE_CACHE:
+                pooled_output, label_ids = [t.to(DEVICE) for t in batch]
+                logits = model.classifier(model.dropout(pooled_output))
+            else:
+                input_ids, segment_ids, input_mask, label_ids = [t.to(DEVICE) for t in batch]
+                logits = model(input_ids, segment_ids, input_mask, labels=None)
 
             loss = nn.CrossEntropyLoss()(logits.view(-1, NUM_LABELS), label_ids.view(-1))
 
@@ -1,15 +1,22 @@
 import torch
 
 
-def pairwise_distances(input):
-    delta = input.unsqueeze(0) - input.unsqueeze(1)
-    dist = torch.norm(delta, 2, 2)
+def pairwise_distances(input, squared=False):
+    # |a - b|^2 = |a|^2 - 2 a.b + |b|^2, computed with a single matmul instead of a (B, B, D) delta
+    dot = torch.mm(input, input.t())
+    square_norm = dot.diagonal()
+    dist = (square_norm.unsqueeze(0) - 2. * dot + square_norm.unsqueeze(1)).clamp(min=0)
+
+    if not squared:
+        # sqrt has infinite gradient at 0
+        zero = (dist == 0).float()
+        dist = (dist + zero * 1e-16).sqrt() * (1 - zero)
 
     return dist
 
 
 def get_valid_positive_mask(labels):
-    indices_equal = torch.eye(labels.size(0)).byte().to(labels.device)
+    indices_equal = torch.eye(labels.size(0), dtype=torch.bool, device=labels.device)
     indices_not_equal = ~indices_equal
 
     label_equal = torch.eq(labels.unsqueeze(1), labels.unsqueeze(0))
@@ -19,7 +26,7 @@ def get_valid_positive_mask(labels):
 
 
 def get_valid_negative_mask(labels):
-    indices_equal = torch.eye(labels.size(0)).byte().to(labels.device)
+    indices_equal = torch.eye(labels.size(0), dtype=torch.bool, device=labels.device)
     indices_not_equal = ~indices_equal
 
     label_not_equal = torch.ne(labels.unsqueeze(1), labels.unsqueeze(0))
@@ -34,7 +41,7 @@ def get_valid_triplets_mask(labels):
         - a,p,n are distinct embeddings
         - a and p have the same label, while a and n have different label
     """
-    indices_equal = torch.eye(labels.size(0)).byte().to(labels.device)
+    indices_equal = torch.eye(labels.size(0), dtype=torch.bool, device=labels.device)
     indices_not_equal = ~indices_equal
     i_ne_j = indices_not_equal.unsqueeze(2)
     i_ne_k = indices_not_equal.unsqueeze(1)
@@ -51,26 +58,35 @@ def get_valid_triplets_mask(labels):
     return mask
 
 
-def batch_all_triplet_loss(input, target, margin):
+def batch_all_triplet_loss(input, target, margin, chunk_size=16):
+    # anchors are processed in blocks, so at most (chunk_size, B, B) triplets are materialized at once
     distances = pairwise_distances(input)
+    mask_positive = get_valid_positive_mask(target)
+    mask_negative = get_valid_negative_mask(target)
+
+    triplet_loss = 0.
+    num_positive_triplets = 0.
+    num_valid_triplets = 0.
+    for i in range(0, input.size(0), chunk_size):
+        anchor_positive_dist = distances[i:i + chunk_size].unsqueeze(2)
+        anchor_negative_dist = distances[i:i + chunk_size].unsqueeze(1)
+        loss = anchor_positive_dist - anchor_negative_dist + margin
 
-    anchor_positive_dist = distances.unsqueeze(2)
-    anchor_negative_dist = distances.unsqueeze(1)
-    triplet_loss = anchor_positive_dist - anchor_negative_dist + margin
+        # a valid positive and a valid negative of the same anchor make a valid triplet
+        mask = mask_positive[i:i + chunk_size].unsqueeze(2) & mask_negative[i:i + chunk_size].unsqueeze(1)
 
-    # get a 3D mask to filter out invalid triplets
-    mask = get_valid_triplets_mask(target)
+        loss = loss * mask.float()
+        loss = loss.clamp(min=0)
 
-    triplet_loss = triplet_loss * mask.float()
-    triplet_loss.clamp_(min=0)
+        triplet_loss = triplet_loss + loss.sum()
+        num_positive_triplets = num_positive_triplets + (loss > 0).float().sum()
+        num_valid_triplets = num_valid_triplets + mask.float().sum()
 
     # count the number of positive triplets
     epsilon = 1e-16
-    num_positive_triplets = (triplet_loss > 0).float().sum()
-    num_valid_triplets = mask.float().sum()
     fraction_positive_triplets = num_positive_triplets / (num_valid_triplets + epsilon)
 
-    triplet_loss = triplet_loss.sum() / (num_positive_triplets + epsilon)
+    triplet_loss = triplet_loss / (num_positive_triplets + epsilon)
 
     return triplet_loss  # , fraction_positive_triplets
 
@@ -89,3 +105,27 @@ def batch_hard_triplet_loss(input, target, margin):
     triplet_loss = (hardest_positive_dist - hardest_negative_dist + margin).clamp(min=0)
 
     return triplet_loss
+
+
+def batch_semi_hard_triplet_loss(input, target, margin):
+    # for every (anchor, positive) pair picks the closest negative that is further than the positive,
+    # or the furthest negative if there is none. negatives of every anchor are sorted once
+    # and looked up with searchsorted, so memory stays (B, B)
+    distances = pairwise_distances(input)
+    mask_positive = get_valid_positive_mask(target)
+    mask_negative = get_valid_negative_mask(target)
+
+    negative_dist = distances.masked_fill(~mask_negative, float('inf'))
+    negative_dist, _ = negative_dist.sort(dim=1)
+    num_negatives = mask_negative.sum(1, keepdim=True)
+
+    index = torch.searchsorted(negative_dist, distances.contiguous(), right=True)
+    index = torch.where(index < num_negatives, index, num_negatives - 1).clamp(min=0)
+    semi_hard_negative_dist = negative_dist.gather(1, index)
+
+    mask = mask_positive & (num_negatives > 0)
+    triplet_loss = (distances - semi_hard_negative_dist + margin).clamp(min=0)
+    triplet_loss = torch.where(mask, triplet_loss, torch.zeros_like(triplet_loss))
+    triplet_loss = triplet_loss.sum() / mask.float().sum().clamp(min=1)
+
+    return triplet_loss